@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic index file.
+
+Usage: generate.py [options] [<output>]
+
+Options:
+  -d, --datasets <datasets>        Number of datasets [default: 1000]
+  -f, --files <files>              Number of files per dataset [default: 4]
+  -t, --tags <tags>                Number of metadata tags [default: 8]
+  -c, --cardinality <cardinality>  Number of distinct values of each tag
+                                   [default: 10]
+  -r, --replicates <fraction>      Fraction of datasets pooled as replicates
+                                   [default: 0.1]
+  -s, --seed <seed>                Random seed [default: 0]
+
+The index is written to standard output if <output> is not specified. The
+generated file uses the default index format.
+"""
+import sys
+import random
+
+# file types and views of the generated files
+FILE_TYPES = [('fastq', 'FastqRd1'), ('fastq', 'FastqRd2'),
+              ('bam', 'Alignments'), ('bigwig', 'Signal'),
+              ('gtf', 'Transcripts'), ('gff', 'Junctions')]
+
+
+def dataset_id(number):
+    """Return the id of the dataset ``number``"""
+    return 'D%07d' % number
+
+
+def rows(datasets=1000, files=4, tags=8, cardinality=10, replicates=0.1,
+         seed=0):
+    """Generate the index rows as (path, tags) tuples. ``tags`` is a list of
+    (key, value) tuples. The rows of a dataset have the same metadata and
+    one file each. Pooled replicates are datasets made of consecutive
+    datasets and are generated after all the other datasets.
+
+    :keyword datasets: the number of datasets. Default: 1000
+    :keyword files: the number of files per dataset. Default: 4
+    :keyword tags: the number of metadata tags. Default: 8
+    :keyword cardinality: the number of distinct values of each tag.
+    Default: 10
+    :keyword replicates: the fraction of datasets pooled as replicates.
+    Default: 0.1
+    :keyword seed: the random seed. Default: 0
+    """
+    rand = random.Random(seed)
+    metadata = {}
+    for number in xrange(datasets):
+        dsid = dataset_id(number)
+        meta = [('tag%d' % tag, 'value%d' % rand.randrange(cardinality))
+                for tag in xrange(tags)]
+        meta.append(('replicate', str(number % 2 + 1)))
+        metadata[dsid] = meta
+        for number_ in xrange(files):
+            ftype, view = FILE_TYPES[number_ % len(FILE_TYPES)]
+            path = '/data/%s/%s_%d.%s' % (dsid[-3:], dsid, number_, ftype)
+            yield path, [('id', dsid)] + meta + [
+                ('size', str(rand.randrange(1, 1 << 30))),
+                ('md5', '%032x' % rand.getrandbits(128)),
+                ('type', ftype), ('view', view)]
+    pooled = int(datasets * replicates) / 2
+    for number in xrange(pooled):
+        first, second = dataset_id(2 * number), dataset_id(2 * number + 1)
+        path = '/data/pooled/%s_%s.bam' % (first, second)
+        yield path, [('id', '%s,%s' % (first, second))] + [
+            (key, value) for key, value in metadata[first]
+            if key != 'replicate'] + [
+                ('size', str(rand.randrange(1, 1 << 30))),
+                ('md5', '%032x' % rand.getrandbits(128)),
+                ('type', 'bam'), ('view', 'PooledAlignments')]
+
+
+def generate(output, **kwargs):
+    """Write a synthetic index to the file object ``output`` and return the
+    number of lines written. See :func:`rows` for the keyword arguments."""
+    count = 0
+    for path, tags in rows(**kwargs):
+        output.write('%s\t%s\n' % (
+            path, ' '.join('%s=%s;' % tag for tag in tags)))
+        count += 1
+    return count
+
+
+def main():
+    """Main function"""
+    from docopt import docopt
+    args = docopt(__doc__)
+    kwargs = dict(datasets=int(args['--datasets']),
+                  files=int(args['--files']),
+                  tags=int(args['--tags']),
+                  cardinality=int(args['--cardinality']),
+                  replicates=float(args['--replicates']),
+                  seed=int(args['--seed']))
+    if args['<output>']:
+        with open(args['<output>'], 'w') as output:
+            generate(output, **kwargs)
+    else:
+        generate(sys.stdout, **kwargs)
+
+
+if __name__ == '__main__':
+    main()
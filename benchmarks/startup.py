@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Measure the start up time of the command line tool.
+
+Usage: startup.py [options] [<args>...]
+
+Options:
+  -n, --runs <runs>  Number of runs [default: 20]
+  --imports          Show the cumulative import time of each module for one
+                     run (like 'python -X importtime' on newer Pythons)
+  --limit <limit>    Number of modules shown with --imports [default: 20]
+
+The arguments are passed to the command line tool. Default: 'show' on a
+one line index file using the default format.
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# do not use the configuration or the server of the current session
+ENV = dict([(k, v) for k, v in os.environ.items()
+            if k not in ['IDX_FILE', 'IDX_FORMAT']], IDX_SOCKET='')
+
+RUN = """
+import sys
+sys.argv = ['idxtools'] + sys.argv[1:]
+from indexfile.cli.indexfile_main import main
+main()
+"""
+
+# wrap __import__ to time module imports in a fresh interpreter
+IMPORTS = """
+import sys, time, __builtin__
+_import = __builtin__.__import__
+times = {}
+depth = [0]
+def timed_import(name, *args, **kwargs):
+    new = name not in sys.modules
+    start = time.time()
+    depth[0] += 1
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        depth[0] -= 1
+        if new and name in sys.modules:
+            times[name] = (time.time() - start, depth[0])
+__builtin__.__import__ = timed_import
+sys.argv = ['idxtools'] + sys.argv[1:]
+try:
+    from indexfile.cli.indexfile_main import main
+    main()
+finally:
+    __builtin__.__import__ = _import
+    for name, (secs, level) in sorted(times.items(), key=lambda x: -x[1][0]):
+        sys.stderr.write('%8.1f ms  %s%s\\n' % (secs * 1000, '  ' * level, name))
+"""
+
+
+def run(code, args):
+    """Run ``code`` in a new interpreter and return the elapsed time"""
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([sys.executable, '-c', code] + args,
+                              stdout=devnull, cwd=ROOT, env=ENV)
+    return time.time() - start
+
+
+def main():
+    """Main function"""
+    args = docopt(__doc__)
+    cmd_args = args['<args>']
+    if not cmd_args:
+        fd, path = tempfile.mkstemp(suffix='.txt')
+        os.write(fd, 'a.txt\tid=1; type=txt;\n')
+        os.close(fd)
+        cmd_args = ['-i', path, 'show']
+    if args['--imports']:
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen([sys.executable, '-c', IMPORTS] + cmd_args,
+                                    stdout=devnull, stderr=subprocess.PIPE,
+                                    cwd=ROOT, env=ENV)
+            lines = proc.communicate()[1].splitlines()
+        print '\n'.join(lines[:int(args['--limit'])])
+        return
+    baseline = sorted(run('pass', []) for dummy in range(int(args['--runs'])))
+    times = sorted(run(RUN, cmd_args) for dummy in range(int(args['--runs'])))
+    print 'interpreter  min %6.1f ms  median %6.1f ms' % (
+        baseline[0] * 1000, baseline[len(baseline) / 2] * 1000)
+    print 'idxtools     min %6.1f ms  median %6.1f ms' % (
+        times[0] * 1000, times[len(times) / 2] * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""
+Run the index benchmarks on synthetic index files.
+
+Usage: suite.py [options] [<scenario>...]
+
+Options:
+  -s, --sizes <sizes>      Comma separated numbers of files of the generated
+                           indexes [default: 1000,10000,100000]
+  -f, --files <files>      Number of files per dataset [default: 4]
+  -t, --tags <tags>        Number of metadata tags [default: 8]
+  -c, --cardinality <cardinality>  Number of distinct values of each tag
+                           [default: 10]
+  -n, --runs <runs>        Number of runs of each scenario. The fastest run is
+                           reported [default: 3]
+  -o, --output <file>      Write the results as JSON to <file>
+  -b, --baseline <file>    Compare the results with a JSON results file
+  --threshold <ratio>      Maximum allowed ratio between a result and its
+                           baseline [default: 1.2]
+  -l, --list               List the scenarios
+
+All the scenarios are run if none is specified. The exit status is 1 if a
+result is slower than its baseline by more than the threshold.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import platform
+import simplejson as json
+from docopt import docopt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import indexfile
+from indexfile.index import Index
+from generate import generate, dataset_id
+
+
+def _load(path):
+    """Return the index loaded from ``path``"""
+    index = Index(path)
+    index.open()
+    return index
+
+
+def _numeric(index):
+    """Store the file sizes of ``index`` as integers to allow numeric
+    queries. Values read from index files are strings."""
+    for dataset in index.datasets.values():
+        for dummy_path, info in dataset:
+            info['size'] = int(info['size'])
+    return index
+
+
+def bench_open(ctx):
+    """Load the index file"""
+    start = time.time()
+    _load(ctx['path'])
+    return time.time() - start
+
+
+def _lookup(query, setup=None):
+    """Return a scenario running a lookup with ``query``"""
+    def bench(ctx):
+        index = ctx['index']
+        if setup is not None:
+            if setup.__name__ not in ctx:
+                ctx[setup.__name__] = setup(_load(ctx['path']))
+            index = ctx[setup.__name__]
+        start = time.time()
+        index.lookup(**query)
+        return time.time() - start
+    bench.__doc__ = 'Query by %s' % ', '.join(
+        '%s=%s' % item for item in sorted(query.items()))
+    return bench
+
+
+def _export(export_type, tags=None):
+    """Return a scenario exporting the index as ``export_type``"""
+    def bench(ctx):
+        start = time.time()
+        for dummy_line in ctx['index'].iter_export(export_type=export_type,
+                                                   tags=tags):
+            pass
+        return time.time() - start
+    bench.__doc__ = 'Export in %s format' % export_type
+    return bench
+
+
+def bench_save(ctx):
+    """Save the index to a new file"""
+    path = os.path.join(ctx['tmpdir'], 'saved.txt')
+    start = time.time()
+    ctx['index'].save(path)
+    elapsed = time.time() - start
+    os.remove(path)
+    return elapsed
+
+
+def bench_insert(ctx):
+    """Insert 1000 files into new and existing datasets"""
+    index = _load(ctx['path'])
+    start = time.time()
+    for number in xrange(1000):
+        index.insert(id=dataset_id(number * 7 % (ctx['datasets'] * 2)),
+                     path='/data/new/%d.bam' % number, type='bam',
+                     view='Alignments', tag0='value0')
+    return time.time() - start
+
+
+def bench_remove(ctx):
+    """Remove 100 datasets in one call"""
+    index = _load(ctx['path'])
+    queries = [dict(id=dataset_id(number * 7 % ctx['datasets']))
+               for number in xrange(100)]
+    start = time.time()
+    index.remove(*queries)
+    return time.time() - start
+
+
+SCENARIOS = [
+    ('open', bench_open),
+    ('lookup_exact', _lookup(dict(tag0='value1', exact=True))),
+    ('lookup_regex', _lookup(dict(tag0='value1.*', view='Fastq.*'))),
+    ('lookup_numeric', _lookup(dict(size='>536870912'), _numeric)),
+    ('export_index', _export('index')),
+    ('export_tab', _export('tab', ['id', 'path', 'tag0', 'view'])),
+    ('export_json', _export('json')),
+    ('save', bench_save),
+    ('insert', bench_insert),
+    ('remove', bench_remove),
+]
+
+
+def run(scenarios, sizes, runs=3, files=4, tags=8, cardinality=10):
+    """Run the benchmarks and return the results as a list of dictionaries
+
+    :param scenarios: a list of (name, function) tuples
+    :param sizes: a list with the numbers of files of the generated indexes
+    """
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='idxbench.')
+    try:
+        for size in sizes:
+            datasets = max(size / files, 1)
+            path = os.path.join(tmpdir, 'index_%d.txt' % size)
+            with open(path, 'w') as output:
+                lines = generate(output, datasets=datasets, files=files,
+                                 tags=tags, cardinality=cardinality)
+            ctx = dict(path=path, tmpdir=tmpdir, datasets=datasets,
+                       index=_load(path))
+            for name, bench in scenarios:
+                elapsed = min(bench(ctx) for dummy in xrange(runs))
+                sys.stderr.write('%-16s %10d %10.4f s\n' % (name, size,
+                                                            elapsed))
+                results.append(dict(scenario=name, size=size, lines=lines,
+                                    time=elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio between the results and the baseline results and
+    return the list of regressions"""
+    reference = dict(((r['scenario'], r['size']), r['time'])
+                     for r in baseline.get('results', []))
+    regressions = []
+    for result in results:
+        base = reference.get((result['scenario'], result['size']))
+        if not base:
+            continue
+        ratio = result['time'] / base
+        mark = ''
+        if ratio > threshold:
+            regressions.append(result)
+            mark = '  REGRESSION'
+        print '%-16s %10d %10.4f s %10.4f s %6.2fx%s' % (
+            result['scenario'], result['size'], base, result['time'], ratio,
+            mark)
+    return regressions
+
+
+def main():
+    """Main function"""
+    args = docopt(__doc__)
+    if args['--list']:
+        for name, bench in SCENARIOS:
+            print '%-16s %s' % (name, bench.__doc__)
+        return
+    names = args['<scenario>']
+    unknown = set(names) - set(name for name, dummy in SCENARIOS)
+    if unknown:
+        sys.exit('Unknown scenarios: %s' % ', '.join(sorted(unknown)))
+    scenarios = [(name, bench) for name, bench in SCENARIOS
+                 if not names or name in names]
+    sizes = [int(size) for size in args['--sizes'].split(',')]
+    results = run(scenarios, sizes, runs=int(args['--runs']),
+                  files=int(args['--files']), tags=int(args['--tags']),
+                  cardinality=int(args['--cardinality']))
+    report = dict(version=indexfile.__version__,
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  results=results)
+    if args['--output']:
+        with open(args['--output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if args['--baseline']:
+        with open(args['--baseline']) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  float(args['--threshold']))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,9 +30,9 @@ class CustomFormatter(logging.Formatter):
 
     FORMATS = {
         logging.DEBUG: '[DBG] %(name)s - %(funcName)s - %(message)s',
-        logging.WARN: '[WARN] %(msg)s',
-        logging.ERROR: '[ERR] %(msg)s',
-        'DEFAULT': '%(msg)s'
+        logging.WARN: '[WARN] %(message)s',
+        logging.ERROR: '[ERR] %(message)s',
+        'DEFAULT': '%(message)s'
     }
     # dbg_time = '%m/%d/%Y %H:%M:%S'
 
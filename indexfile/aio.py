@@ -0,0 +1,198 @@
+"""Asynchronous module.
+
+The module provide a wrapper around :class:`Index` running loading, queries,
+saving and locking in a thread pool so that callers like event loops are not
+blocked. Operations return :class:`multiprocessing.pool.AsyncResult`
+objects and accept an optional callback called with the result.
+
+"""
+import Queue
+import threading
+from multiprocessing.pool import ThreadPool
+from indexfile.index import Index
+
+# setup logger
+import indexfile
+# Disable warning about invalid constant name
+# pylint: disable=C0103
+log = indexfile.getLogger(__name__)
+# pylint: enable=C0103
+
+# default number of worker threads of the shared pool
+DEFAULT_POOL_SIZE = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(size=None):
+    """Return the thread pool shared by all asynchronous indexes. The pool
+    is created on first use.
+
+    :keyword size: the number of worker threads. Only used when the pool is
+    created. Default: None (use ``DEFAULT_POOL_SIZE``)
+    """
+    # pylint: disable=W0603
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(size or DEFAULT_POOL_SIZE)
+        return _pool
+
+
+class AsyncIndex(object):
+    """Run the blocking operations of an :class:`Index` in a thread pool.
+
+    Each instance serializes its own operations, so an index is never
+    modified and saved at the same time, while many instances can run
+    concurrently in the pool.
+    """
+
+    def __init__(self, index=None, pool=None):
+        """Create an asynchronous index
+
+        :keyword index: the :class:`Index` instance or the path to the index
+        file. Default: None (empty index)
+        :keyword pool: the thread pool used to run operations. Default: None
+        (use the shared pool)
+        """
+        if not isinstance(index, Index):
+            index = Index(index)
+        self.index = index
+        self.pool = pool or get_pool()
+        self._op_lock = threading.Lock()
+
+    def _apply(self, func, args=(), kwargs=None, callback=None):
+        """Run ``func`` in the pool holding the instance lock"""
+        def call():
+            with self._op_lock:
+                return func(*args, **(kwargs or {}))
+        return self.pool.apply_async(call, callback=callback)
+
+    def open(self, path=None, callback=None):
+        """Load the index file. See :meth:`Index.open`."""
+        return self._apply(self.index.open, (path,), callback=callback)
+
+    def lookup(self, callback=None, **kwargs):
+        """Query the index. The result is an :class:`AsyncIndex` wrapping the
+        resulting index. See :meth:`Index.lookup`."""
+        def lookup():
+            return AsyncIndex(self.index.lookup(**kwargs), self.pool)
+        return self._apply(lookup, callback=callback)
+
+    def save(self, path=None, callback=None, **kwargs):
+        """Write the index file. See :meth:`Index.save`."""
+        return self._apply(self.index.save, (path,), kwargs, callback)
+
+    def lock(self, shared=False, timeout=None, callback=None):
+        """Lock the index file. The lock is waited for in the pool. See
+        :meth:`Index.lock`."""
+        return self.pool.apply_async(self.index.lock, (shared, timeout),
+                                     callback=callback)
+
+    def release(self):
+        """Release the lock on the index file. See :meth:`Index.release`."""
+        return self.index.release()
+
+    def export(self, max_lines=1000, **kwargs):
+        """Return an :class:`ExportStream` iterating over the exported
+        lines. See :meth:`Index.iter_export`.
+
+        :keyword max_lines: the maximum number of lines buffered ahead of the
+        consumer. Default: 1000
+        """
+        return ExportStream(self.index.iter_export(**kwargs), max_lines,
+                            self._op_lock)
+
+    def __len__(self):
+        return len(self.index)
+
+
+class ExportStream(object):
+    """Iterate over lines produced by a background thread.
+
+    Lines are buffered in a bounded queue. :meth:`get` can be used to poll
+    the stream with a timeout; iterating blocks until the next line is
+    available. The background thread stops when the stream is closed, when
+    leaving a ``with`` block or when the stream is no longer referenced.
+    """
+
+    _END = object()
+
+    def __init__(self, lines, max_lines=1000, lock=None):
+        self._queue = Queue.Queue(max_lines)
+        self._closed = threading.Event()
+        self._errors = []
+        self._done = False
+        # the thread does not reference the stream, so that a stream no
+        # longer used is collected and closed
+        self._thread = threading.Thread(
+            target=self._produce, name='ExportStream',
+            args=(lines, self._queue, lock or threading.Lock(), self._closed,
+                  self._errors))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _put(queue, item, closed):
+        """Put ``item`` into the queue unless the stream is closed. Return
+        True if the item was put."""
+        while not closed.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _produce(lines, queue, lock, closed, errors):
+        """Background thread putting lines into the queue"""
+        try:
+            with lock:
+                for line in lines:
+                    if not ExportStream._put(queue, line, closed):
+                        return
+        # pylint: disable=W0703
+        except Exception, exc:
+            errors.append(exc)
+        # pylint: enable=W0703
+        ExportStream._put(queue, ExportStream._END, closed)
+
+    def get(self, timeout=None):
+        """Return the next line. Raise :class:`Queue.Empty` if no line is
+        available within ``timeout`` seconds and :class:`StopIteration` at
+        the end of the stream.
+
+        :keyword timeout: the number of seconds to wait. Default: None (wait
+        until a line is available)
+        """
+        if self._done:
+            raise StopIteration
+        item = self._queue.get(timeout=timeout)
+        if item is self._END:
+            self._done = True
+            if self._errors:
+                raise self._errors[0]
+            raise StopIteration
+        return item
+
+    def close(self):
+        """Stop producing lines"""
+        self._closed.set()
+        self._done = True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return self.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
@@ -3,72 +3,98 @@ Command line interface to the IndexFile API
 """
 import sys
 import os
-import csv
-import imp
-import yaml
-import glob
+import time
 import indexfile
-import simplejson as json
 from os import environ as env
-from schema import SchemaError
-from indexfile.index import Index
+from contextlib import contextmanager
 
 DEFAULT_CONFIG_FILE = '.indexfile.yml'
 DEFAULT_ENV_INDEX = 'IDX_FILE'
 DEFAULT_ENV_FORMAT = 'IDX_FORMAT'
-
-IGNORE_COMMANDS = ['__init__', 'indexfile_main']
-
-def walk_up(bottom):
+DEFAULT_ENV_PROFILE = 'IDX_PROFILE'
+
+# the configuration file is not looked for above directories containing
+# one of these entries
+PROJECT_MARKERS = ['.git', '.hg', '.svn']
+
+# parsed configuration files by path, with their modification time and size
+_config_cache = {}
+
+# available commands. The command modules (indexfile_<name>) are only
+# imported when the command is run
+COMMANDS = {
+    'batch': {
+        'desc': "Run many commands on the index",
+        'aliases': []
+    },
+    'remove': {
+        'desc': "Remove files from the index",
+        'aliases': ['rm']
+    },
+    'serve': {
+        'desc': "Run an index server",
+        'aliases': []
+    },
+    'show': {
+        'desc': "Show the index",
+        'aliases': []
+    },
+    'update': {
+        'desc': "Add or update file/dataset metadata to the index",
+        'aliases': ['add']
+    }
+}
+
+
+def find_config(path, name=DEFAULT_CONFIG_FILE):
+    """Return the path of the configuration file looked for in ``path``
+    and its parent directories, or None if not found. Only the candidate
+    files are checked, directories are never listed. The search stops at
+    filesystem boundaries and at project directories (see
+    ``PROJECT_MARKERS``).
     """
-    mimic os.walk, but walk 'up'
-    instead of down the directory tree
-    """
-
-    bottom = os.path.realpath(bottom)
-
-    #get files in current dir
+    path = os.path.realpath(path)
     try:
-        names = os.listdir(bottom)
-    except Exception as e:
-        print e
-        return
-
-    dirs, nondirs = [], []
-    for name in names:
-        if os.path.isdir(os.path.join(bottom, name)):
-            dirs.append(name)
-        else:
-            nondirs.append(name)
-
-    yield bottom, dirs, nondirs
-
-    new_path = os.path.realpath(os.path.join(bottom, '..'))
-
-    # see if we are at the top
-    if new_path == bottom:
-        return
-
-    for x in walk_up(new_path):
-        yield x
+        device = os.stat(path).st_dev
+    except OSError:
+        return None
+    while True:
+        candidate = os.path.join(path, name)
+        if os.path.isfile(candidate):
+            return candidate
+        if [m for m in PROJECT_MARKERS
+                if os.path.exists(os.path.join(path, m))]:
+            return None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        try:
+            if os.stat(parent).st_dev != device:
+                return None
+        except OSError:
+            return None
+        path = parent
+
+
+def read_config(config_file):
+    """Return the parsed configuration file. Parsed files are cached and
+    parsed again only when modified."""
+    from copy import deepcopy
+    stat = os.stat(config_file)
+    signature = (stat.st_mtime, stat.st_size)
+    cached = _config_cache.get(config_file)
+    if cached is None or cached[0] != signature:
+        import yaml
+        with open(config_file) as config:
+            cached = (signature, yaml.load(config) or {})
+        _config_cache[config_file] = cached
+    return deepcopy(cached[1])
 
 
 def load_commands():
-    """Load commands from files"""
-    basedir = os.path.dirname(__file__)
-    cmds = glob.glob('{0}/*.py'.format(basedir))
-    d = {}
-
-    for cmd in cmds:
-        mod = os.path.basename(cmd).replace('.py', '')
-        if mod in IGNORE_COMMANDS:
-            continue
-        info = imp.find_module(mod, [basedir])
-        m = imp.load_module(mod, *info)
-        d[m.name] = {'desc': m.desc, 'aliases': m.aliases}
-
+    """Return the command table"""
+    d = dict([(k, dict(v)) for k, v in COMMANDS.iteritems()])
     d['help'] = {'desc': "Show the help"}
-
     return d
 
 
@@ -102,7 +128,8 @@ def default_config():
     """Return the default configuration"""
     config = {}
     config['loglevel'] = indexfile._log_level
-    config['format'] = json.dumps(indexfile.default_format)
+    # use indexfile.default_format
+    config['format'] = None
     return config
 
 
@@ -123,25 +150,58 @@ def load_config(path=None, args=None, use_env=True):
             update_config(config, {'index': env.get(DEFAULT_ENV_INDEX)})
         if DEFAULT_ENV_FORMAT in env:
             update_config(config, {'format': env.get(DEFAULT_ENV_FORMAT)})
-    if path:
-        if os.path.isdir(path):
-            for c, d, f in walk_up(path):
-                if DEFAULT_CONFIG_FILE in f:
-                    config_file = os.path.join(c, DEFAULT_CONFIG_FILE)
-                    update_config(config, yaml.load(open(config_file)))
-                    break
+    if path and os.path.isdir(path):
+        config_file = find_config(path)
+        if config_file:
+            update_config(config, read_config(config_file))
     if args:
         update_config(config, args)
     return config
 
 
-def open_index(config):
-    """Open index file from config dictionary"""
+def is_index_set(index):
+    """Return True if the index configuration refers to many index files
+    (a glob pattern or a comma separated list). Defined here, and imported
+    by :mod:`indexfile.indexset`, so that checking the configuration does
+    not load the index modules."""
+    import glob
+    return isinstance(index, basestring) and (
+        ',' in index or glob.has_magic(index))
+
+
+def open_index(config, shared=False):
+    """Open index file from config dictionary
+
+    :keyword shared: specify if the index file has to be locked shared while
+    loading it, for read-only commands. Default: False
+    """
+    import csv
+    from indexfile.index import Index
+    from indexfile.utils import is_sqlite
 
-    i = Index()
     index = config.get('index')
     idx_format = config.get('format')
+    lock_timeout = config.get('locktimeout')
+
+    if is_index_set(index):
+        from indexfile.indexset import IndexSet
+        i = IndexSet(index, format=idx_format)
+        if lock_timeout is not None:
+            i.lock_timeout = float(lock_timeout)
+        return i
 
+    i = Index()
+    if is_sqlite(index):
+        from indexfile.sqlite import SQLiteIndex
+        i = SQLiteIndex()
+    if lock_timeout is not None:
+        i.lock_timeout = float(lock_timeout)
+
+    locked = False
+    if shared and type(index) in [str, unicode] and not is_sqlite(index):
+        # do not load the file while it is being saved
+        i.path = os.path.abspath(index)
+        locked = i.lock(shared=True)
     try:
         i.set_format(idx_format)
         i.open(index)
@@ -150,10 +210,130 @@ def open_index(config):
         i.open(index)
     except AttributeError:
         pass
+    finally:
+        if locked:
+            i.release()
 
     return i
 
 
+def forward_command(config, command, args):
+    """Run a command on a running index server. Return the exit status, or
+    None if no server is running or the command has to be run locally."""
+    from indexfile import client
+    index = config.get('index')
+    if type(index) not in [str, unicode] or set(args) & set(['-', 'stdin']):
+        return None
+    if command == 'batch' and not args:
+        # the script is read from the standard input
+        return None
+    if command == 'show' and set(args) & set(['-w', '--watch']):
+        # watching would block the server
+        return None
+    if is_index_set(index):
+        return None
+    idx_format = config.get('format')
+    if idx_format and os.path.isfile(idx_format):
+        idx_format = os.path.abspath(idx_format)
+    server_config = {
+        'index': os.path.abspath(index),
+        'format': idx_format
+    }
+    return client.request(command, args, server_config)
+
+
+class Profile(object):
+    """Collect the time spent in the phases of a command and the peak memory
+    usage, and optionally run the command under :mod:`cProfile`.
+    """
+
+    # the active profile
+    current = None
+
+    def __init__(self, dump=None):
+        """Create a profile
+
+        :keyword dump: the path of the file where :mod:`cProfile`
+        statistics are written. Default: None (no cProfile statistics)
+        """
+        self.dump = dump
+        self.phases = []
+        self._depth = 0
+        self._start = time.time()
+        self._profiler = None
+        if dump:
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing a phase. Phases can be nested."""
+        entry = [name, self._depth, None]
+        self.phases.append(entry)
+        self._depth += 1
+        start = time.time()
+        try:
+            yield
+        finally:
+            entry[2] = time.time() - start
+            self._depth -= 1
+
+    def stop(self):
+        """Stop profiling and write the cProfile statistics, if requested"""
+        if self._profiler is not None:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.dump)
+            self._profiler = None
+
+    def report(self, out=None):
+        """Write the timing and memory report to ``out``. Default: standard
+        error"""
+        import resource
+        out = out or sys.stderr
+        total = time.time() - self._start
+        width = max([len(name) + 2 * depth
+                     for name, depth, dummy in self.phases] + [len('total')])
+        for name, depth, secs in self.phases:
+            if secs is None:
+                continue
+            label = '  ' * depth + name
+            out.write('[profile] %s %10.1f ms\n' % (label.ljust(width),
+                                                    secs * 1000))
+        out.write('[profile] %s %10.1f ms\n' % ('total'.ljust(width),
+                                                total * 1000))
+        # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak /= 1024
+        out.write('[profile] peak memory %.1f MB\n' % (peak / 1024.0))
+        if self.dump:
+            out.write('[profile] cProfile statistics written to %s\n' %
+                      self.dump)
+
+
+def profile_from_env():
+    """Return the profile options from the ``IDX_PROFILE`` environment
+    variable: a tuple with a flag and the cProfile output file. A value
+    other than 1/true/yes is used as the output file."""
+    value = env.get(DEFAULT_ENV_PROFILE, '')
+    if value.lower() in ['', '0', 'false', 'no']:
+        return False, None
+    if value.lower() in ['1', 'true', 'yes']:
+        return True, None
+    return True, value
+
+
+@contextmanager
+def phase(name):
+    """Time a phase of the command in the active profile, if any"""
+    if Profile.current is None:
+        yield
+        return
+    with Profile.current.phase(name):
+        yield
+
+
 # validation objects
 class Command(object):
 
@@ -163,6 +343,7 @@ class Command(object):
 
     def validate(self, data):
         """Return valid command string or SchemaException in case of error"""
+        from schema import SchemaError
         if not data:
             data = 'help'
         if data in self._commands.keys() + get_command_aliases(self._commands):
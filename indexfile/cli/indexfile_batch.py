@@ -0,0 +1,84 @@
+"""
+Run many commands on the index. Commands are read from a script file, or
+from the standard input, one per line, with the same arguments and options
+used on the command line, eg. 'rm id=ID001' or 'show -t path type=bam'.
+Text following a '#' is ignored.
+
+The index is loaded and locked once and it is saved once at the end, if
+any command changed it. Nothing is saved if a command fails.
+
+Usage: %s [<script>]
+"""
+import sys
+import shlex
+import importlib
+import indexfile
+from docopt import docopt
+from indexfile.cli import load_commands, get_command
+
+# set command info
+name = __name__.replace('indexfile_','')
+desc = "Run many commands on the index"
+aliases = []
+
+# commands not allowed in a batch
+EXCLUDED_COMMANDS = ['batch', 'help', 'serve']
+
+
+def parse_script(script):
+    """Iterate over the commands in a script as (line number, command,
+    arguments) tuples"""
+    commands = load_commands()
+    for number, line in enumerate(script, 1):
+        argv = shlex.split(line, comments=True)
+        if not argv:
+            continue
+        try:
+            cmd = get_command(argv[0], commands)
+        except IndexError:
+            raise ValueError('Line %d: unknown command %s' % (number, argv[0]))
+        if cmd in EXCLUDED_COMMANDS:
+            raise ValueError('Line %d: %s cannot be run in a batch' % (
+                number, cmd))
+        yield number, cmd, argv[1:]
+
+
+def run_command(index, cmd, argv):
+    """Run a command with the arguments ``argv`` on the index"""
+    module = importlib.import_module('indexfile.cli.indexfile_%s' % cmd)
+    module.command = '%s %s' % (indexfile.__name__, cmd)
+    sys_argv = sys.argv
+    sys.argv = [indexfile.__name__, cmd] + argv
+    try:
+        module.run(index)
+    except SystemExit, exc:
+        if exc.code not in [None, 0]:
+            raise ValueError(exc.code)
+    finally:
+        sys.argv = sys_argv
+
+
+def run(index):
+    """Run many commands on the index"""
+    log = indexfile.getLogger(__name__)
+
+    args = docopt(__doc__ % command)
+
+    script = args.get('<script>')
+    if script in [None, '-', 'stdin']:
+        script = sys.stdin
+    else:
+        script = open(script)
+
+    with index.batch():
+        for number, cmd, argv in parse_script(script):
+            log.debug('Line %d: run %s %s', number, cmd, ' '.join(argv))
+            try:
+                run_command(index, cmd, argv)
+            except IOError:
+                raise
+            except Exception, exc:
+                raise ValueError('Line %d: %s' % (number, exc))
+
+if __name__ == '__main__':
+    run(index)
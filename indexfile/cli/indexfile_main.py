@@ -1,16 +1,31 @@
 #! /usr/bin/env python
 """
 
-Usage: %s [-i <index>] [-f <format>] [--loglevel <loglevel>] [<command>]
-          [<args>...] %s [--version] [--help]
+Usage: %s [-i <index>] [-f <format>] [--loglevel <loglevel>]
+          [--lock-timeout <seconds>] [--generations] [--stats] [--profile]
+          [--profile-dump <file>] [<command>] [<args>...]
+       %s [--version] [--help]
 
 Options:
   -h, --help             Show this help message and exit
   --version              Show the version information
   --loglevel <level>     Set the log level to one of error|warn|info|debug
-  -i, --index <index>    The input index file.
+  -i, --index <index>    The input index file. Many index files can be given
+                         as a comma separated list or a glob pattern.
   -f, --format <format>  Index format specifications in JSON format. Can be a
                          file or a string.
+  --lock-timeout <seconds>  Maximum time to wait for the index lock.
+  --generations          Save the index to a new generation file and make the
+                         index path a link to it. Index files already saved
+                         as generations are always saved as generations
+  --stats                Print index and lock statistics as JSON to standard
+                         error
+  --profile              Print the time spent in each phase of the command
+                         and the peak memory usage to standard error. Can
+                         also be enabled with the IDX_PROFILE environment
+                         variable
+  --profile-dump <file>  Write cProfile statistics to a file. Implies
+                         --profile. IDX_PROFILE can also be set to the file
 
 The main commands are:
 
@@ -22,7 +37,14 @@ import runpy
 import indexfile
 from docopt import docopt
 from schema import Schema, And, Or, Use, Optional
-from indexfile.cli import open_index, load_config, Command, get_command, load_commands, get_commands_help
+from indexfile.cli import open_index, load_config, Command, get_command, load_commands, get_commands_help, forward_command, is_index_set, Profile, profile_from_env, phase
+
+# commands only reading the index
+READ_ONLY_COMMANDS = ['show']
+
+# options applied to the local session only
+LOCAL_OPTIONS = ['loglevel', 'locktimeout', 'generations', 'stats',
+                 'profile', 'profiledump']
 
 
 def main():
@@ -36,6 +58,7 @@ def main():
 
         # local variables
         index = None
+        profile = None
 
         # load commands
         commands = load_commands()
@@ -46,7 +69,8 @@ def main():
             'index': Or(None,
                         And(Or('-', 'stdin'),
                             Use(lambda x: sys.stdin)),
-                        open),
+                        open,
+                        is_index_set),
             Optional('format'): open,
             Optional('loglevel'): And(str,
                                       Use(str.lower),
@@ -54,6 +78,7 @@ def main():
                                          'warn',
                                          'info',
                                          'debug')),
+            Optional('locktimeout'): Or(None, Use(float)),
             '<command>': Command(commands=commands),
             str: object
         })
@@ -65,23 +90,48 @@ def main():
         # validate args
         args = sch.validate(args)
 
+        profiling, dump = profile_from_env()
+        if args.get('profile') or args.get('profiledump') or profiling:
+            profile = Profile(dump=args.get('profiledump') or dump)
+            Profile.current = profile
+
         # deal with 'help' command
         if args.get('<command>') == 'help':
             docopt(helpstr, version="%s v%s" % (name, version), argv=['--help'])
 
         # load the index and delegate command
-        config = load_config(os.getcwd(), args)
+        with phase('config'):
+            config = load_config(os.getcwd(), args)
 
         indexfile.setLogLevel(config.get('loglevel'))
-        index = open_index(config)
-
         command_ = get_command(args.get('<command>'), commands)
+
+        # use the index server if running. The options of the session are
+        # not sent to the server, the command runs locally if any is set
+        local = [option for option in LOCAL_OPTIONS if args.get(option)]
+        if command_ != 'serve' and not local and Profile.current is None:
+            with phase('forward'):
+                status = forward_command(config, command_, args['<args>'])
+            if status is not None:
+                sys.exit(status)
+
+        if args.get('stats'):
+            from indexfile.index import Index
+            Index.collect_stats = True
+        if args.get('generations'):
+            from indexfile.index import Index
+            Index.generations = True
+        with phase('open'):
+            index = open_index(config,
+                               shared=command_ in READ_ONLY_COMMANDS)
+
         argv = [name, command_] + args['<args>']
         sys.argv = argv
         module_ = "indexfile.cli.indexfile_%s" % command_
-        runpy.run_module(module_,
-                         run_name="__main__",
-                         init_globals={'index': index, 'command': '{0} {1}'.format(name, command_)})
+        with phase(command_):
+            runpy.run_module(module_,
+                             run_name="__main__",
+                             init_globals={'index': index, 'command': '{0} {1}'.format(name, command_)})
 
     except KeyboardInterrupt, e:
         sys.exit(1)
@@ -99,6 +149,13 @@ def main():
     finally:
         if index is not None:
             index.release()
+            if args.get('stats'):
+                import simplejson as json
+                sys.stderr.write("%s\n" % json.dumps(index.stats()))
+        if profile is not None:
+            Profile.current = None
+            profile.stop()
+            profile.report()
 
 
 if __name__ == '__main__':
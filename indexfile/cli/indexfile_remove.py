@@ -2,22 +2,33 @@
 Remove files and/or datasets from the index. Query can be a file path or a string
 like 'id=ID001' or 'type=bam'.
 
-Usage: %s [options] <query>...
+Usage: %s [options] [<query>...]
 
 Options:
 
-  -c, --clear  Remove a dataset entry in the index if it does not contain any
-               more files [default: false]
+  -c, --clear          Remove a dataset entry in the index if it does not
+                       contain any more files [default: false]
+  --from-file <file>   Read queries from a file, one per line. Use '-' for
+                       the standard input
 
 """
+import sys
 from docopt import docopt
-from schema import Schema, Use, Optional
+from schema import Schema, Use, Optional, Or, And
 
 # set command info
 name = __name__.replace('indexfile_','')
 desc = "Remove files from the index"
 aliases = ['rm']
 
+
+def parse_query(query):
+    """Return the query dictionary for a query string"""
+    if '=' in query:
+        return dict([query.split('=', 1)])
+    return {'path': query}
+
+
 def run(index):
     """Remove files and/or datasets from the index"""
 
@@ -28,20 +39,25 @@ def run(index):
     # create validation schema
     sch = Schema({
         Optional('clear'): Use(bool),
+        'fromfile': Or(None,
+                       And(Or('-', 'stdin'),
+                           Use(lambda x: sys.stdin)),
+                       Use(open)),
         str: object
     })
     args = sch.validate(args)
 
-    index.lock()
     queries = args.get('<query>')
-    for query in queries:
-        if '=' in query:
-            kwargs = dict([query.split('=')])
-            kwargs['clear'] = args.get('clear')
-            index.remove(**kwargs)
-        else:
-            index.remove(path=query, clear=args.get('clear'))
-        index.save()
+    if args.get('fromfile'):
+        queries += [line.strip() for line in args.get('fromfile')
+                    if line.strip()]
+    if not queries:
+        return
+
+    index.lock()
+    index.remove(*[parse_query(query) for query in queries],
+                 clear=args.get('clear'))
+    index.save()
 
 if __name__ == '__main__':
     run(index)
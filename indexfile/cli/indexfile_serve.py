@@ -0,0 +1,54 @@
+"""
+Run a server keeping indexes loaded in memory. While the server is running,
+the other commands are sent to it and run without reloading the index.
+Indexes are reloaded when their files change. Commands run with options
+of the main command, such as --stats or --lock-timeout, are not sent to the
+server.
+
+Usage: %s [options]
+
+Options:
+
+  -s, --socket <socket>  The socket path. Default: the IDX_SOCKET environment
+                         variable or a file in the XDG_RUNTIME_DIR folder
+                         or in a private per-user temporary folder
+"""
+import sys
+import signal
+import indexfile
+from docopt import docopt
+from schema import Schema, Optional
+from indexfile.server import IndexServer
+
+# set command info
+name = __name__.replace('indexfile_','')
+desc = "Run an index server"
+aliases = []
+
+def run(index):
+    """Run an index server"""
+    log = indexfile.getLogger(__name__)
+
+    # parser args and remove dashes
+    args = docopt(__doc__ % command)
+    args = dict([(k.replace('-', ''), v) for k, v in args.iteritems()])
+
+    # create validation schema
+    sch = Schema({
+        Optional('socket'): object,
+        str: object
+    })
+    args = sch.validate(args)
+
+    server = IndexServer(args.get('socket'))
+    log.info('Listening on %s', server.socket_path)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    run(index)
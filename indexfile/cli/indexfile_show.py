@@ -1,6 +1,7 @@
 """
 Select datasets using query strings. Examples of valid strings are: 'sex=M' and 'lab=CRG'.
-Multiple fields in a query are joind with an 'AND'.
+Multiple fields in a query are joind with an 'AND'. When many index files
+are given, they are queried in parallel and a 'source' column is added.
 
 Usage: %s [options] [<query>]...
 
@@ -17,6 +18,17 @@ Options:
                          false]
   -o, --output <output>  The output file. [default: stdout]
   --header               Output header when selecting tags
+  -j, --json             Output one JSON object per line. The JSON backend
+                         can be set with the IDX_JSON_BACKEND environment
+                         variable
+  --sort-buffer <rows>   Maximum number of rows sorted in memory. Larger
+                         outputs are sorted using temporary files
+  -w, --watch            Keep watching the index file for changes and output
+                         the new matches or the updated count. Lines
+                         appended to the index file are loaded, while a
+                         replaced file is loaded again
+  --interval <seconds>   Number of seconds between checks of the index file
+                         when watching [default: 1]
 """
 import os
 import re
@@ -24,12 +36,106 @@ import sys
 from schema import Schema, And, Or, Use, Optional
 from docopt import docopt
 from indexfile.index import Index
+from indexfile.indexset import IndexSet
+from indexfile.cli import phase
 
 # set command info
 name = __name__.replace('indexfile_','')
 desc = "Show the index"
 aliases = []
 
+def _dataset_lines(index, keys, query, export):
+    """Return a dictionary with the set of output lines of the datasets in
+    ``keys`` matching the query, indexed by dataset id"""
+    lines = {}
+    for key in keys:
+        dataset = index.datasets.get(key)
+        if dataset is None:
+            continue
+        result = Index(datasets={key: dataset}, format=index.format)
+        result.path = index.path
+        if query:
+            result = result.lookup(**query)
+            result.path = index.path
+        lines[key] = set(result.iter_export(**export))
+    return lines
+
+
+def watch(index, query, args, matched=None, count=None, export=None,
+          locked=False):
+    """Watch the index file and output the new matches or the updated
+    count when it changes. Only the datasets added or changed are checked
+    against the query after each change.
+
+    :param query: the query dictionary or None
+    :keyword matched: the set of matching dataset ids, to output the count
+    of matching datasets. Default: None
+    :keyword count: the current count. Without ``matched`` the count of
+    output lines is output. Default: None
+    :keyword export: the export options, to output the matching lines.
+    Default: None
+    :keyword locked: specify if the index was locked by the command and has
+    to be released. Default: False
+    """
+    output = args.get('output')
+    output.flush()
+    if locked:
+        # do not block writers while watching
+        index.release()
+    lines = counts = None
+    if count is not None and matched is None:
+        # the number of datasets with each output line, to count the
+        # distinct lines after each change
+        lines = _dataset_lines(index, index.datasets, query, export)
+        counts = {}
+        for dataset_lines in lines.values():
+            for line in dataset_lines:
+                counts[line] = counts.get(line, 0) + 1
+    for added in index.watch(interval=args.get('interval')):
+        if matched is not None or counts is not None:
+            changed = set(added.datasets)
+            if matched is not None:
+                # datasets removed when the file is replaced
+                changed.update(matched.difference(index.datasets))
+            else:
+                changed.update(set(lines).difference(index.datasets))
+        if counts is not None:
+            new = _dataset_lines(index, changed, query, export)
+            for key in changed:
+                for line in lines.pop(key, ()):
+                    counts[line] -= 1
+                    if not counts[line]:
+                        del counts[line]
+                for line in new.get(key, ()):
+                    counts[line] = counts.get(line, 0) + 1
+                if new.get(key):
+                    lines[key] = new[key]
+            if len(counts) != count:
+                count = len(counts)
+                output.write("%s%s" % (count, os.linesep))
+            output.flush()
+            continue
+        if matched is not None:
+            # check the whole changed datasets, which can also stop
+            # matching the query
+            result = Index(datasets=dict(
+                (key, index.datasets[key]) for key in changed
+                if key in index.datasets), format=index.format)
+            if query:
+                result = result.lookup(**query)
+            matched.difference_update(changed)
+            matched.update(result.datasets)
+            if len(matched) != count:
+                count = len(matched)
+                output.write("%s%s" % (count, os.linesep))
+        else:
+            if query:
+                added = added.lookup(**query)
+            for line in added.iter_export(**export):
+                output.write('%s%s' % (line, os.linesep))
+        output.flush()
+
+
 def run(index):
     """Show index contents and filter based on query terms"""
     export_type = 'index'
@@ -52,6 +158,10 @@ def run(index):
                          Use(lambda x: sys.stdout)),
                      Use(lambda f: open(f, 'w+'))),
         Optional('header'): Use(bool),
+        Optional('json'): Use(bool),
+        'sortbuffer': Or(None, Use(int)),
+        Optional('watch'): Use(bool),
+        'interval': Use(float),
         str: object
     })
     args = sch.validate(args)
@@ -69,50 +179,80 @@ def run(index):
             tags = args.get("tags").split(',')
         if args.get('tags') == 'attrs':
             header = True
+    if args.get('json'):
+        export_type = 'json'
 
-    index.lock()
+    # the index can already be locked, eg. in a batch
+    locked = index.lock(shared=True)
 
     try:
         indices = []
         query = args.get('<query>')
+        kwargs = {}
         if query:
             list_sep = r'[:\s]'
-            kwargs = {}
             for qry in query:
                 match = re.match(r'(?P<key>[^=<>!]*)=(?P<value>.*)', qry, re.DOTALL)
                 kwargs[match.group('key')] = match.group('value')
                 if re.search(list_sep, kwargs[match.group('key')], re.MULTILINE):
                     kwargs[match.group('key')] = re.split(list_sep, match.group(
                         'value'))
-            indices.append(index.lookup(exact=exact, **kwargs))
+        if isinstance(index, IndexSet):
+            indices.append(index)
+        elif query:
+            with phase('lookup'):
+                indices.append(index.lookup(exact=exact, **kwargs))
         else:
             indices.append(index)
+        query = dict(kwargs, exact=exact) if kwargs else None
+
+        if args.get('watch') and not isinstance(index, Index):
+            raise ValueError('Only single index files can be watched')
 
         for i in indices:
-            if isinstance(i, Index):
-                if args.get('count') and not args.get('tags'):
+            if isinstance(i, IndexSet) and args.get('count') and not args.get('tags'):
+                # the number of datasets, as for a single index
+                args.get('output').write("%s%s" % (i.count(query),
+                                                   os.linesep))
+                return
+            if isinstance(i, (Index, IndexSet)):
+                if isinstance(i, Index) and args.get('count') and not args.get('tags'):
                     args.get('output').write("%s%s" % (len(i), os.linesep))
+                    if args.get('watch'):
+                        watch(index, query, args, matched=set(i.datasets),
+                              count=len(i), locked=locked)
                     return
                 kwargs = {
                     'header': header,
                     'export_type': export_type,
                     'tags': tags,
                     'absolute': absolute,
-                    'hide_missing': hide_missing
+                    'hide_missing': hide_missing,
+                    'sort_buffer': args.get('sortbuffer')
                 }
                 if not map_keys:
                     kwargs['map'] = None
-                indexp = i.export(**kwargs)
-                if args.get('count'):
-                    args.get('output').write("%s%s" % (len(indexp), os.linesep))
-                    return
-                for line in indexp:
-                    # print the atribute names only
-                    if args.get('tags') == 'attrs':
-                        args.get('output').write("\n".join(line.split()))
-                        args.get('output').write("\n")
-                        break
-                    args.get('output').write('%s%s' % (line, os.linesep))
+                if isinstance(i, IndexSet):
+                    kwargs['query'] = query
+                indexp = i.iter_export(**kwargs)
+                with phase('export'):
+                    if args.get('count'):
+                        count = sum(1 for dummy_line in indexp)
+                        args.get('output').write("%s%s" % (count, os.linesep))
+                        if args.get('watch'):
+                            watch(index, query, args, count=count,
+                                  export=kwargs, locked=locked)
+                        return
+                    for line in indexp:
+                        # print the atribute names only
+                        if args.get('tags') == 'attrs':
+                            args.get('output').write("\n".join(line.split()))
+                            args.get('output').write("\n")
+                            break
+                        args.get('output').write('%s%s' % (line, os.linesep))
+                if args.get('watch'):
+                    watch(index, query, args, export=dict(
+                        kwargs, header=False), locked=locked)
 
     except Exception:
         if args.get('output') != sys.stdout:
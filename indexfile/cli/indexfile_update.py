@@ -7,12 +7,18 @@ Options:
   -l --metadata-list <list>     List of metadata information to be used.
   -a --attributes <attributes>  List of attribute names referring to the metadata
                                 list.
+  -d --delimiter <delimiter>    The metadata list column delimiter: whitespace,
+                                tab, comma, space or any character. With a
+                                delimiter other than whitespace, values are
+                                quoted as in CSV files [default: whitespace]
   -u --update                   Update information for existing datasets
   -f --force                    Only works in combination with --update. Add non-existing keys to the dataset.
+  --progress <rows>             Report progress every <rows> rows
 """
 
 import re
 import sys
+import csv
 import indexfile
 from schema import Schema, Use, Optional, Or, And
 from docopt import docopt
@@ -22,6 +28,29 @@ name = __name__.replace('indexfile_','')
 desc = "Add or update file/dataset metadata to the index"
 aliases = ['add']
 
+DELIMITERS = {'whitespace': None, 'tab': '\t', 'comma': ',', 'space': ' '}
+
+
+def read_rows(mdlist, header, delimiter=None):
+    """Iterate over the rows of a metadata list as dictionaries. Values are
+    separated by whitespace if ``delimiter`` is None, otherwise the list is
+    read as a CSV file with the given delimiter."""
+    if delimiter is None:
+        rows = ((number, line.split()) for number, line in
+                enumerate(mdlist, 1))
+    else:
+        reader = csv.reader(mdlist, delimiter=delimiter,
+                            skipinitialspace=True)
+        rows = ((reader.line_num, row) for row in reader)
+    for number, row in rows:
+        if not row:
+            continue
+        if len(row) != len(header):
+            raise ValueError('Line %d: expected %d values, found %d' % (
+                number, len(header), len(row)))
+        yield dict(zip(header, row))
+
+
 def run(index):
     """Add or update metadata information to the index"""
     log = indexfile.getLogger(__name__)
@@ -37,8 +66,11 @@ def run(index):
                        Use(lambda x: sys.stdin)),
                        Use(open)),
         'attributes': Or(And(None, Use(lambda x: "")), str),
+        'delimiter': And(Use(lambda x: DELIMITERS.get(x, x)),
+                         lambda x: x is None or len(x) == 1),
         Optional('update'): Use(bool),
         Optional('force'): Use(bool),
+        'progress': Or(None, Use(int)),
         str: object
     })
     args = sch.validate(args)
@@ -52,12 +84,10 @@ def run(index):
     force = args.get("force")
     kwargs = {}
     if not infos and mdlist:
-        for file_ in mdlist.readlines():
-            file_ = file_.split()
-            assert len(file_) == len(header)
-            for i, k in enumerate(header):
-                kwargs[k] = file_[i]
-            index.insert(update=update, addkeys=force, **kwargs)
+        rows = read_rows(mdlist, header, args.get('delimiter'))
+        count = index.insert_many(rows, update=update, addkeys=force,
+                                  log_every=args.get('progress'))
+        log.info('Inserted %d rows', count)
         index.save()
     elif infos:
         for info in infos:
@@ -0,0 +1,105 @@
+"""Client module.
+
+The module provide the functions to send command line tools requests to an
+index server (see :mod:`indexfile.server`). It is imported by every command
+line invocation, so it only uses light modules.
+
+"""
+import os
+import sys
+import socket
+import tempfile
+
+DEFAULT_ENV_SOCKET = 'IDX_SOCKET'
+
+
+def socket_dir():
+    """Return the private folder of the default socket. Use the
+    ``XDG_RUNTIME_DIR`` environment variable if set, or a per-user folder in
+    the temporary folder."""
+    return os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        tempfile.gettempdir(), 'idxtools-%d' % os.getuid())
+
+
+def default_socket():
+    """Return the default socket path. Use the ``IDX_SOCKET`` environment
+    variable if set. An empty variable disables the server."""
+    if DEFAULT_ENV_SOCKET in os.environ:
+        return os.environ[DEFAULT_ENV_SOCKET]
+    return os.path.join(socket_dir(), 'idxtools.sock')
+
+
+def is_owned(path):
+    """Return True if ``path`` exists and is owned by the current user.
+    Symbolic links are not followed."""
+    try:
+        return os.lstat(path).st_uid == os.getuid()
+    except OSError:
+        return False
+
+
+def write_frame(wfile, kind, data):
+    """Write a data frame. ``kind`` is one of 'out', 'err' or 'exit'."""
+    wfile.write('%s %d\n%s' % (kind, len(data), data))
+
+
+def read_frames(rfile):
+    """Iterate over the frames read from ``rfile``"""
+    while True:
+        header = rfile.readline()
+        if not header:
+            return
+        kind, size = header.split()
+        yield kind, rfile.read(int(size))
+
+
+def ping(socket_path=None):
+    """Return True if a server is listening on ``socket_path``"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path or default_socket())
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def request(command, args, config, socket_path=None, out=None, err=None):
+    """Send a command request to a server and write its output to ``out``
+    and ``err``. Return the exit status, or None if no server is running.
+    """
+    socket_path = socket_path or default_socket()
+    if not is_owned(socket_path):
+        # do not send requests to servers run by other users
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    import simplejson as json
+    out = out or sys.stdout
+    err = err or sys.stderr
+    try:
+        wfile = sock.makefile('wb')
+        wfile.write('%s\n' % json.dumps({
+            'command': command,
+            'args': args,
+            'config': config,
+            'cwd': os.getcwd()
+        }))
+        wfile.close()
+        status = 1
+        for kind, data in read_frames(sock.makefile('rb')):
+            if kind == 'out':
+                out.write(data)
+            elif kind == 'err':
+                err.write(data)
+            elif kind == 'exit':
+                status = int(data)
+        out.flush()
+        return status
+    finally:
+        sock.close()
@@ -1,10 +1,8 @@
 import os
 import sys
 import csv
-import simplejson as json
 import tempfile
-import simplejson as json
-from lockfile import LockFile
+import threading
 from copy import deepcopy
 from indexfile.utils import *
 from copy import copy, deepcopy
@@ -18,6 +16,9 @@ import indexfile
 log = indexfile.getLogger(__name__)
 # pylint: enable=C0103
 
+# serialize decoding of lazy datasets shared between threads
+_decode_lock = threading.Lock()
+
 class Dataset(dict):
     """A class that represent dataset in the index file.
 
@@ -33,6 +34,7 @@ class Dataset(dict):
         self.__dict__['_metadata'] = DotDict()
         self.__dict__['_files'] = DotDict()
         self.__dict__['_attributes'] = {}
+        self.__dict__['_tags_cache'] = {}
 
         if not fileinfo:
             fileinfo = indexfile.default_format.get('fileinfo')
@@ -49,6 +51,55 @@ class Dataset(dict):
 
         if is_file:
             self.add_file(**kwargs)
+        # a new dataset is not changed
+        self.__dict__.pop('_touched', None)
+
+    @classmethod
+    def from_lines(cls, lines, decode):
+        """Create a dataset from raw index file lines. The lines are only
+        decoded when the dataset metadata or files are first accessed.
+
+        :param lines: a list of index file lines
+        :param decode: a function returning a tuple with the dataset
+        metadata and the file information of a line, as dictionaries. The
+        file information is None for lines without files.
+        """
+        dataset = cls.__new__(cls)
+        dataset.__dict__.update(_attributes={}, _tags_cache={},
+                                _raw=list(lines), _decode=decode)
+        return dataset
+
+    def add_line(self, line):
+        """Add a raw index file line to a dataset created with
+        :meth:`from_lines`. Return False if the dataset was already
+        decoded."""
+        raw = self.__dict__.get('_raw')
+        if raw is None:
+            return False
+        raw.append(line)
+        return True
+
+    def _decode_lines(self):
+        """Decode the raw lines of the dataset"""
+        decode = self.__dict__['_decode']
+        dataset, files = None, []
+        for line in self.__dict__['_raw']:
+            meta, info = decode(line)
+            if dataset is None:
+                # metadata of the following lines is ignored as when
+                # inserting lines without updating
+                dataset = Dataset(**meta)
+            if info is not None:
+                files.append(info)
+        self.__dict__['_metadata'] = dataset._metadata
+        self.__dict__['_files'] = dataset._files
+        del self.__dict__['_raw']
+        del self.__dict__['_decode']
+        touched = self.__dict__.get('_touched')
+        for info in files:
+            self.add_file(**info)
+        if not touched:
+            self.__dict__.pop('_touched', None)
 
     def add_file(self, update=False, fileinfo=None, **kwargs):
         """Add a file to the dataset files dictionary. ``kwargs`` contains
@@ -81,6 +132,7 @@ class Dataset(dict):
 
         if not path in self._files:
             self._files[path] = {}
+        self.__dict__['_touched'] = True
 
         for key, val in kwargs.items():
             if key == 'path' or key not in fileinfo:
@@ -108,13 +160,15 @@ class Dataset(dict):
             log.debug('Delete entry for %s', path)
             if path in self._files:
                 del self._files[path]
+                self.__dict__['_touched'] = True
         else:
             log.debug('Delete all %r entries', type)
             for f in [k for k,v in self._files.items()
                          if v.type == type]:
                 del self._files[f]
+                self.__dict__['_touched'] = True
 
-    def export(self, types=None, tags=None):
+    def export(self, types=None, tags=None, extra=None):
         """Export a :class:Dataset object to a list of dictionaries (one for
         each file).
 
@@ -124,13 +178,19 @@ class Dataset(dict):
 
         :keyword tags: the list of tags to be exported. If set only the
         sepcified tags will be put on output. Default: Nene (all tags exported)
+
+        :keyword extra: a dictionary containing additional information for
+        some of the files, indexed by path. Default: None
         """
         out = []
+        if not extra:
+            extra = {}
         if not tags:
             tags = self._metadata.keys() + ['path', 'type']
             if self._files:
                 tags.extend([k for v in self._files.values()
                              for k in v.keys()])
+                tags.extend([k for v in extra.values() for k in v.keys()])
             tags = list(set(tags))
         templates = [t for t in tags if '{' in t]
         if not types:
@@ -149,6 +209,8 @@ class Dataset(dict):
             if info.type in types:
                 log.debug('Export type %r', info.type)
                 items = self._metadata.items() + {'path': path, 'type': info.type}.items() + info.items()
+                if path in extra:
+                    items += extra[path].items()
                 data = dict(items)
                 for t in templates:
                     data = map_path(data, t)
@@ -157,6 +219,48 @@ class Dataset(dict):
                 out.append(data)
         return out
 
+    def project(self, tags, extra=None):
+        """Export the values of ``tags`` for each file as tuples, with the
+        values in the same order as ``tags``. Missing values are None. Only
+        the requested values are gathered and path templates are rendered
+        only if requested. See :meth:`export`.
+
+        :param tags: the list of tags to be exported
+        :keyword extra: a dictionary containing additional information for
+        some of the files, indexed by path. Default: None
+        """
+        meta = self._metadata
+        if not self._files:
+            return [tuple([meta.get(t) for t in tags])]
+        if not extra:
+            extra = {}
+        templates = [t for t in tags if '{' in t]
+        out = []
+        for path, info in self._files.items():
+            data = extra.get(path, {})
+            if templates:
+                data = dict(meta.items() + {'path': path,
+                                            'type': info.type}.items() +
+                            info.items() + data.items())
+                for t in templates:
+                    data = map_path(data, t)
+                out.append(tuple([data.get(t) for t in tags]))
+                continue
+            row = []
+            for t in tags:
+                if t in data:
+                    row.append(data[t])
+                elif t in info:
+                    row.append(info[t])
+                elif t == 'path':
+                    row.append(path)
+                elif t == 'type':
+                    row.append(info.type)
+                else:
+                    row.append(meta.get(t))
+            out.append(tuple(row))
+        return out
+
     def get_meta_tags(self):
         """Return all metadata tag names"""
         return self._metadata.keys()
@@ -188,6 +292,24 @@ class Dataset(dict):
         data = dict([i for i in self._metadata.iteritems() if i[0] in tags])
         return to_tags(**data)
 
+    def get_tags_list(self, serializer):
+        """Return the sorted list of metadata tags formatted by
+        ``serializer`` and a dictionary with the corresponding key value
+        pairs. The result is cached until a dataset attribute changes.
+
+        :param serializer: a :class:`TagSerializer` instance
+        """
+        cache = self.__dict__['_tags_cache']
+        if serializer.key not in cache:
+            keymap = serializer.keymap or {}
+            meta = {}
+            for key, val in self._metadata.items():
+                key = keymap.get(key, key)
+                if key:
+                    meta[key] = val
+            cache[serializer.key] = (serializer.tag_list(meta.items()), meta)
+        return cache[serializer.key]
+
     def merge(self, datasets, sep=',', dsid='id'):
         """Merge metadata of this dataset with the ones from another dataset
 
@@ -219,6 +341,19 @@ class Dataset(dict):
         if not kwargs:
             return None
         exact = kwargs.pop('exact', False)
+        paths = self.match_files(exact=exact, **kwargs)
+        if paths is None:
+            return None
+        return self.clone(paths)
+
+    def match_files(self, exact=False, **kwargs):
+        """Return the list of paths of the files matching the file
+        information in kwargs. Metadata keys are ignored. Return None if
+        kwargs contains no file information or if some of it does not match
+        any file.
+
+        :keyword exact: exact matching of values. Default: False
+        """
         files = []
         for k, v in kwargs.items():
             if k in self._metadata:
@@ -233,7 +368,7 @@ class Dataset(dict):
             files.append(set(path))
         if not files:
             return None
-        return self.clone(list(set.intersection(*files)))
+        return list(set.intersection(*files))
 
     def clone(self, paths=None):
         """Return a copy of the datasets"""
@@ -247,6 +382,7 @@ class Dataset(dict):
         new_ds.__dict__['_metadata'] = deepcopy(metadata)
         new_ds.__dict__['_files'] = deepcopy(files)
         new_ds.__dict__['_attributes'] = deepcopy(attrs)
+        new_ds.__dict__['_tags_cache'] = {}
 
         return new_ds
 
@@ -257,6 +393,11 @@ class Dataset(dict):
         return self._files.get(key)
 
     def __getattr__(self, name):
+        if name in ['_metadata', '_files'] and '_raw' in self.__dict__:
+            with _decode_lock:
+                if '_raw' in self.__dict__:
+                    self._decode_lines()
+            return self.__dict__[name]
         if name in self.__dict__['_attributes'].keys():
             return self.__dict__['_attributes'][name](self)
         if name in self._metadata.keys():
@@ -266,7 +407,9 @@ class Dataset(dict):
 
     def __setattr__(self, name, value):
         if name != '__dict__':
-            self.__dict__['_metadata'][name] = value
+            self._metadata[name] = value
+            self.__dict__['_tags_cache'].clear()
+            self.__dict__['_touched'] = True
 
     def __repr__(self):
         return "(Dataset)"
@@ -286,6 +429,9 @@ class Dataset(dict):
         return len(self._files)
 
     def __nonzero__(self):
+        if '_raw' in self.__dict__:
+            # lazy datasets have at least the id
+            return True
         return bool(self.__dict__['_metadata'])
 
     def __contains__(self, item):
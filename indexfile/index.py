@@ -7,10 +7,11 @@ import re
 import os
 import sys
 import csv
-import yaml
+import time
+import hashlib
 import tempfile
-import simplejson as json
-from lockfile import LockFile
+import functools
+from contextlib import contextmanager
 from copy import deepcopy
 from indexfile.utils import *
 from copy import copy, deepcopy
@@ -24,11 +25,133 @@ log = indexfile.getLogger(__name__)
 # pylint: enable=C0103
 
 
+def _reading(method):
+    """Hold the index lock for reading while running ``method`` on a
+    thread-safe index"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._rwlock is None:
+            return method(self, *args, **kwargs)
+        with self._rwlock.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _writing(method):
+    """Hold the index lock for writing while running ``method`` on a
+    thread-safe index"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._rwlock is None:
+            return method(self, *args, **kwargs)
+        with self._rwlock.writing():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _timed(operation):
+    """Add the time spent running ``method`` to the ``operation`` timer
+    when collecting statistics"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self._stats is None:
+                return method(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                timers = self._stats['time']
+                timers[operation] = timers.get(operation, 0.0) + \
+                    time.time() - start
+        return wrapper
+    return decorator
+
+
+def _new_stats():
+    """Return the initial statistics counters"""
+    return {'lines_parsed': 0, 'datasets_inserted': 0, 'files_inserted': 0,
+            'lookups': 0, 'datasets_scanned': 0, 'datasets_matched': 0,
+            'saves': 0, 'bytes_written': 0, 'time': {}}
+
+
+# path values of lines without files
+EMPTY_PATHS = [None, '', '.']
+
+
+def _dataset_meta(kwargs, idx_format):
+    """Return the dataset metadata from the attributes of an index line"""
+    if idx_format.get('fileinfo'):
+        log.debug('Use file specific keywords from the format')
+        return dict([(k, v) for k, v in kwargs.items()
+                     if k not in idx_format.get('fileinfo')])
+    return kwargs
+
+
+def _line_decoder(idx_format):
+    """Return a function decoding an index file line into the dataset
+    metadata and the file information, as done by :meth:`Index.insert`.
+    See :meth:`Dataset.from_lines`."""
+    idx_format = deepcopy(idx_format)
+    dsid = idx_format.get('id', 'id')
+
+    def decode(line):
+        tags = Index.parse_line(line, **idx_format)
+        if 'id' in tags:
+            tags[dsid] = tags.pop('id')
+        info = tags
+        if tags.get('path') in EMPTY_PATHS:
+            info = None
+        return _dataset_meta(tags, idx_format), info
+    return decode
+
+
+def _id_finder(dsid, sep='=', trail=';', **kwargs):
+    """Return a function extracting the dataset id from an index file line
+    without parsing the other attributes. The function returns None if the
+    id cannot be safely extracted and the line has to be fully parsed."""
+    keys = set([dsid, 'id'])
+    expr = re.compile('(?:\t| )(?P<key>%s)%s\"?(?P<value>[^%s\"]*)\"?%s' % (
+        '|'.join(re.escape(k) for k in keys), re.escape(sep),
+        re.escape(trail), re.escape(trail)))
+
+    def find_id(line):
+        # the attributes follow the last tab
+        pos = line.rfind('\t')
+        tags = line[pos:] if pos >= 0 else ' ' + line
+        matches = list(expr.finditer(tags))
+        if len(matches) != 1:
+            return None
+        key, value = matches[0].group('key', 'value')
+        if key != dsid or not value:
+            return None
+        if tags.count('"', 0, matches[0].start()) % 2:
+            # the id is part of a quoted value
+            return None
+        return value
+    return find_id
+
+
 class Index(object):
     """A class to access information stored into 'index files'.
     """
 
-    def __init__(self, path=None, datasets=None, format=None):
+    # default timeout in seconds for acquiring the index lock
+    lock_timeout = None
+
+    # write each save to a new generation file. Index files already stored
+    # as generations are always saved as generations
+    generations = False
+
+    # collect the statistics returned by :meth:`stats`
+    collect_stats = False
+
+    # keep the raw lines of each dataset when loading index files and parse
+    # them only when the dataset metadata or files are first accessed
+    lazy = False
+
+    def __init__(self, path=None, datasets=None, format=None,
+                 threadsafe=False):
         """Creates an instance of an Index
 
         :param path: the path to the index file
@@ -36,6 +159,9 @@ class Index(object):
         Default: None.
         :keyword format: a dictionary containing the format and mapping
         information. Default: None.
+        :keyword threadsafe: specify if the index is shared between threads.
+        Changes are then serialized with an internal readers-writer lock,
+        while queries and exports run concurrently. Default: False
 
         The format information can be expressed with a dictionary as followsclone:
 
@@ -53,13 +179,35 @@ class Index(object):
         self.path = path
 
         self.datasets = datasets or {}
+        self._rwlock = RWLock() if threadsafe else None
         self._lock = None
+        self._lock_stats = {'count': 0, 'wait': 0.0, 'hold': 0.0}
+        self._version = None
+        self._journal = None
+        self._derived = None
+        self._derived_addons = None
+        self._batch = None
+        self._polled = None
+        self._stats = _new_stats() if self.collect_stats else None
         self.format = deepcopy(indexfile.default_format)
         if format:
             self.format.update(format)
         self._lookup = {}
         self._alltags = []
 
+    @property
+    def format(self):
+        """The index format information"""
+        return self._format
+
+    @format.setter
+    def format(self, value):
+        self._format = value
+        # addon values depend on the format
+        self._derived = None
+
+    @_writing
+    @_timed('open')
     def open(self, path=None):
         """Open a file and load/import data into the index
 
@@ -72,15 +220,27 @@ class Index(object):
             log.debug('Use path from Index instance: %s', self.path)
             path = self.path
         log.debug('Open %s', path)
+        self._version = None
+        self._journal = None
+        self._polled = None
         if type(path) == str:
-            with open(os.path.abspath(path), 'r') as index_file:
+            with open_snapshot(os.path.abspath(path)) as index_file:
+                index_file = ChecksumFile(index_file)
                 self._open_file(index_file)
+                version = index_file.version()
+            # changes from now on are loaded by poll
+            self._polled = version[:-1]
             self.path = os.path.abspath(path)
+            # changes made from now on are replayed on save if the file
+            # is modified by someone else in the meantime
+            self._version = (self.path, version)
+            self._journal = []
         if type(path) == file:
             self._open_file(path)
             if path is not sys.stdin:
                 self.path = os.path.abspath(path.name)
 
+    @_writing
     def set_format(self, input_format=None):
         """Set index format from YAML/JSON string or file
 
@@ -92,6 +252,7 @@ class Index(object):
         if not input_format and self.format:
             return
 
+        import yaml
         idx_format = deepcopy(indexfile.default_format)
 
         log.debug('Load format %s', input_format)
@@ -139,7 +300,28 @@ class Index(object):
 
         """
         replicates = []
+        dsid = self.format.get('id', 'id')
+        find_id = None
+        if self.lazy:
+            find_id = _id_finder(dsid, **self.format)
+            decode = _line_decoder(self.format)
+            if self._derived is not None:
+                self._derived = None
         for line in index_file:
+            if self._stats is not None:
+                self._stats['lines_parsed'] += 1
+            if find_id is not None:
+                key = find_id(line)
+                if key is not None and self.format.get('rep_sep') not in key:
+                    dataset = self.datasets.get(key)
+                    if dataset is None:
+                        self.datasets[key] = Dataset.from_lines([line],
+                                                                decode)
+                        if self._stats is not None:
+                            self._stats['datasets_inserted'] += 1
+                        continue
+                    if dataset.add_line(line):
+                        continue
             tags = Index.parse_line(line, **self.format)
             if self.format.get('rep_sep') in tags[self.format.get('id', 'id')]:
                 # postpone inserting replicates lines
@@ -158,6 +340,7 @@ class Index(object):
         format information
 
         """
+        import yaml
         reader = csv.DictReader(index_file, dialect=dialect)
 
         format_file = 'imported_format.yml'
@@ -171,9 +354,12 @@ class Index(object):
             yaml.dump(self.format, open(format_file, 'w'), default_flow_style=False)
 
         for line in reader:
+            if self._stats is not None:
+                self._stats['lines_parsed'] += 1
             tags = Index.map_keys(line, **self.format)
             dataset = self.insert(**tags)
 
+    @_reading
     def find_replicates(self, **kwargs):
         """Try to find replicates in the index using a dataset id made from
         the concatenation of multiple dataset ids
@@ -193,6 +379,8 @@ class Index(object):
                 Please check the dataset ids')
         return [datasets[k] for k in sorted(datasets.keys())]
 
+    @_writing
+    @_timed('insert')
     def insert(self, update=False, addkeys=False, dataset=None, **kwargs):
         """Add a dataset to the index. Keyword arguments contains the dataset
         attributes.
@@ -200,22 +388,24 @@ class Index(object):
         :keyword update: specifies whether existing values has to be updated
         :keyword dataset: the :class:`Dataset` to be inserted into the index
         """
-        empty_paths = [None, '', '.']
+        if self._journal is not None:
+            # a copy, the values can be changed after the insertion
+            self._journal.append(('insert', deepcopy(dict(
+                kwargs, update=update, addkeys=addkeys, dataset=dataset))))
 
         dsid = self.format.get('id', 'id')
 
         if 'id' in kwargs:
             kwargs[dsid] = kwargs.pop('id')
 
-        meta = kwargs
-        if self.format.get('fileinfo'):
-            log.debug('Use file specific keywords from the format')
-            meta = dict([(k, v) for k, v in kwargs.items()
-                        if k not in self.format.get('fileinfo')])
+        meta = _dataset_meta(kwargs, self.format)
         if not dataset:
             dataset = Dataset(**meta)
 
         existing_dataset = self.datasets.get(getattr(dataset, dsid))
+        # changes made by the index are replayed from the journal
+        touched = existing_dataset is not None and \
+            existing_dataset.__dict__.get('_touched')
 
         if existing_dataset is not None:
             if update:
@@ -233,61 +423,454 @@ class Index(object):
                     dataset = reps[0].merge(reps[1:], dsid=dsid)
             self.datasets[getattr(dataset, dsid)] = dataset
             dataset = self.datasets.get(getattr(dataset, dsid))
+            if self._stats is not None:
+                self._stats['datasets_inserted'] += 1
         else:
             log.debug('Use existing dataset %s', getattr(dataset, dsid))
 
-        if kwargs.get('path') not in empty_paths:
+        if kwargs.get('path') not in EMPTY_PATHS:
         #if os.path.isfile(kwargs.get('path')):
             log.debug('Add %s to dataset', kwargs.get('path'))
+            nfiles = len(dataset)
             dataset.add_file(update=update, **kwargs)
-
+            if self._stats is not None:
+                self._stats['files_inserted'] += len(dataset) - nfiles
+            if self._derived is not None:
+                path = kwargs.get('path')
+                derived = self._derived.setdefault(getattr(dataset, dsid), {})
+                derived.pop(path, None)
+                derived.update(self._resolve_addons(dataset, [path]))
+
+        if not touched:
+            dataset.__dict__.pop('_touched', None)
         return dataset
 
-    def remove(self, clear=False, **kwargs):
-        """Remove dataset(s) from the index given a search query.
+    @_writing
+    def insert_many(self, rows, update=False, addkeys=False, log_every=None):
+        """Add many datasets to the index. ``rows`` is an iterable of
+        dictionaries with the dataset attributes, consumed one row at a
+        time. Return the number of inserted rows.
+
+        If the index is exclusively locked, it is first brought up to date
+        with the index file and the rows are not recorded for replaying on
+        save. The index then has to be saved before releasing the lock.
+
+        :keyword update: specifies whether existing values has to be updated
+        :keyword addkeys: add non-existing keys to existing datasets when
+        updating. Default: False
+        :keyword log_every: log progress and throughput as warnings every
+        ``log_every`` rows. Default: None (no progress information)
         """
+        if self._lock is not None and not self._lock.shared:
+            self._merge()
+            self._version = None
+            self._journal = None
+        count = 0
+        start = time.time()
+        for row in rows:
+            self.insert(update=update, addkeys=addkeys, **row)
+            count += 1
+            if log_every and count % log_every == 0:
+                log.warn('Inserted %d rows (%.0f rows/s)', count,
+                         count / max(time.time() - start, 1e-6))
+        log.debug('Inserted %d rows in %.3fs', count, time.time() - start)
+        return count
+
+    def _resolve_addons(self, dataset, paths=None):
+        """Return a dictionary with the values of the format addons for
+        each file of a dataset. Only files with addon values are included.
+
+        :param dataset: the :class:`Dataset` instance
+        :keyword paths: the list of files to be resolved. Default: None (all
+        files)
 
-        dsid = self.format.get('id', 'id')
+        """
+        derived = {}
+        if paths is None:
+            paths = [path for path, dummy_info in dataset]
+        for ak, addon in self.format.get('addons', {}).items(): # addon ~ 'data_type'
+            mapping = addon.get('mapping') # 'view'
+            if not mapping:
+                continue
+            for path in paths:
+                info = dataset[path]
+                if info is not None and info.get(mapping) in addon:
+                    derived.setdefault(path, {})[ak] = addon.get(
+                        info.get(mapping))
+        return derived
+
+    def _get_derived(self):
+        """Return the table of addon values for all the datasets. The table
+        is built at the first call after a change of the format addons, also
+        made in place, and then kept up to date by :meth:`insert`.
+        """
+        addons = self.format.get('addons') or {}
+        if self._derived is None or addons != self._derived_addons:
+            log.debug('Resolve format addons')
+            self._derived = {}
+            self._derived_addons = deepcopy(addons)
+            if addons:
+                for dskey, dataset in self.datasets.items():
+                    self._derived[dskey] = self._resolve_addons(dataset)
+        return self._derived
+
+    @_writing
+    @_timed('remove')
+    def remove(self, *queries, **kwargs):
+        """Remove dataset(s) from the index given one or more search
+        queries. ``kwargs`` contains a query, ``queries`` are dictionaries
+        with additional queries. All the queries are resolved in a single
+        pass over the index.
+
+        A query containing file information removes the matching files. A
+        query with metadata only removes the whole dataset if it contains
+        the dataset id.
+
+        :keyword clear: remove datasets with no more files. Default: False
+        :keyword exact: exact matching of values. Default: False
+        """
+        clear = kwargs.pop('clear', False)
+        exact = kwargs.pop('exact', False)
+        queries = list(queries)
+        if kwargs:
+            queries.append(kwargs)
 
-        if 'id' in kwargs:
-            kwargs[dsid] = kwargs.pop('id')
+        if self._journal is not None:
+            for query in queries:
+                self._journal.append(('remove', deepcopy(dict(
+                    query, clear=clear, exact=exact))))
 
-        datasets = self.lookup(**kwargs).datasets.keys()
-        if datasets:
-            log.debug('Remove datasets %s', datasets)
-            for k in datasets:
-                dataset = self.datasets.get(k)
-                fileinfo = self.format.get('fileinfo')
-                if any([tag in fileinfo for tag in kwargs]):
-                    rmargs = dict((tag, kwargs[tag]) for k in kwargs if k in fileinfo)
-                    log.debug('Remove %s', rmargs)
-                    dataset.rm_file(**rmargs)
+        dsid = self.format.get('id', 'id')
+        fileinfo = self.format.get('fileinfo')
+
+        # queries with a path can only match the dataset owning the file
+        terms, path_terms = [], {}
+        for query in queries:
+            query = dict(query)
+            if 'id' in query:
+                query[dsid] = query.pop('id')
+            term = (query, any([tag in fileinfo for tag in query]))
+            if isinstance(query.get('path'), basestring):
+                path_terms.setdefault(query['path'], []).append(term)
+            else:
+                terms.append(term)
+        owned = {}
+        if path_terms:
+            for k, dataset in self.datasets.items():
+                for path, dummy_info in dataset:
+                    if path in path_terms:
+                        owned.setdefault(k, []).extend(path_terms[path])
+
+        for k, dataset in self.datasets.items():
+            for query, file_query in terms + owned.get(k, []):
+                paths = self._match(dataset, query, exact=exact)
+                if paths is None:
+                    continue
+                if file_query:
+                    log.debug('Remove %s from %s', paths, k)
+                    touched = dataset.__dict__.get('_touched')
+                    for path in paths:
+                        dataset.rm_file(path=path)
+                    if not touched:
+                        dataset.__dict__.pop('_touched', None)
                     if len(dataset) == 0 and clear:
                         del self.datasets[k]
+                        break
+                elif dsid in query:
+                    log.debug('Remove whole %s', dataset)
+                    del self.datasets[k]
+                    break
                 else:
-                    if dsid in kwargs:
-                        log.debug('Remove whole %s', dataset)
-                        del self.datasets[k]
-                    else:
-                        log.debug('Nothing to remove for %s', kwargs)
-
-    def save(self, path=None):
-        """Save changes to the index file
+                    log.debug('Nothing to remove for %s', query)
+
+    @_writing
+    @_timed('save')
+    def save(self, path=None, sort_buffer=None):
+        """Save changes to the index file. The file is replaced atomically.
+
+        If the file was modified after it was opened, the insertions and
+        removals made on this instance are replayed on the current file
+        contents before saving. Changes made to the datasets directly, such
+        as setting their attributes, cannot be replayed and a
+        :class:`StoreException` is raised instead. The index is exclusively
+        locked, if not already locked, only while merging and writing. A
+        :class:`StoreException` is raised if the index is locked shared.
+
+        If ``Index.generations`` is set, or the file is already a link to a
+        generation file, the contents are written to a new generation file
+        (``<path>.gen<N>``) and the link is atomically updated. Readers
+        always see a complete generation and old generations are removed
+        once no reader has them open.
+
+        Saving the index file in a :meth:`batch` is deferred to the end of
+        the batch.
+
+        :keyword sort_buffer: the maximum number of rows to be sorted in
+        memory. See :meth:`export`. Default: None
         """
         if not path and self.path:
             log.debug('Use path from the Index instance')
             path = self.path
-            index = open(path, 'w+')
-        elif not self.path:
-            index = sys.stdout
-        if path != self.path:
-            self.path = os.path.abspath(path)
+        if self._batch is not None and path and \
+                os.path.abspath(path) == self.path:
+            log.debug('Defer saving to the end of the batch')
+            self._batch.update(save=True, sort_buffer=sort_buffer)
+            return
+        if not path:
+            for line in self.iter_export(map=None, sort_buffer=sort_buffer):
+                sys.stdout.write("%s%s" % (line, os.linesep))
+            return
+        self.path = os.path.abspath(path)
         log.debug('Save %s', path)
-        for line in self.export(map=None):
-            index.write("%s%s" % (line, os.linesep))
-
+        if self._lock is not None and self._lock.shared:
+            # other readers may be reading the file
+            raise StoreException('Saving the index requires an exclusive '
+                                 'lock')
+        locked = self._lock is None and self.lock()
+        try:
+            self._merge()
+            generational = self.generations or is_generational(self.path)
+            target = self.path if generational else os.path.realpath(
+                self.path)
+            dirname, basename = os.path.split(target)
+            fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % basename,
+                                            dir=dirname)
+            try:
+                written = 0
+                md5 = hashlib.md5()
+                with os.fdopen(fd, 'w') as index:
+                    for line in self.iter_export(map=None,
+                                                 sort_buffer=sort_buffer):
+                        line = "%s%s" % (line, os.linesep)
+                        written += len(line)
+                        md5.update(line)
+                        index.write(line)
+                if os.path.exists(target):
+                    os.chmod(tmp_path, os.stat(target).st_mode & 0777)
+                else:
+                    umask = os.umask(0)
+                    os.umask(umask)
+                    os.chmod(tmp_path, 0666 & ~umask)
+                if generational:
+                    swap_generation(target, tmp_path)
+                else:
+                    os.rename(tmp_path, target)
+            except:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            version = file_version(self.path, checksum=False)
+            self._version = (self.path, version[:-1] + (md5.hexdigest(),))
+            self._polled = version[:-1]
+            self._journal = []
+            for dataset in self.datasets.itervalues():
+                dataset.__dict__.pop('_touched', None)
+            if self._stats is not None:
+                self._stats['saves'] += 1
+                self._stats['bytes_written'] += written
+        finally:
+            if locked:
+                self.release()
+
+    @contextmanager
+    def batch(self):
+        """Return a context manager running many operations on the index.
+        The index is exclusively locked, if not already locked, and saving
+        the index file is deferred until leaving the context. The index is
+        saved only if :meth:`save` was called in the context and no error
+        occurred. If an error occurs the changes made in the context are
+        discarded. Batches can be nested.
+        """
+        if self._batch is not None:
+            yield self
+            return
+        locked = self.lock()
+        if self._journal is not None:
+            # the changes to replay on the index file to roll back
+            state = list(self._journal)
+        else:
+            state = deepcopy(self.datasets)
+        self._batch = {'save': False}
+        try:
+            yield self
+            if self._batch['save']:
+                sort_buffer = self._batch.get('sort_buffer')
+                self._batch = None
+                self.save(sort_buffer=sort_buffer)
+        except:
+            self._batch = None
+            self._rollback(state)
+            raise
+        finally:
+            self._batch = None
+            if locked:
+                self.release()
+
+    @_writing
+    def poll(self):
+        """Load the changes made to the index file since it was opened or
+        last polled. Changes are detected from the file status, so checking
+        an unchanged file is cheap. If the file only grew, just the lines
+        appended to it are parsed. If the file was replaced or rewritten it
+        is loaded again as a whole and the changes made to this instance are
+        replayed. Return an :class:`Index` with the datasets and files added
+        or changed, or None if the file did not change.
+        """
+        if self._polled is None:
+            raise ValueError('The index was not opened from a file')
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        device, inode, mtime, offset = self._polled
+        if (stat.st_dev, stat.st_ino) != (device, inode) or \
+                stat.st_size < offset:
+            log.debug('Index file replaced. Load %s', self.path)
+            return self._reload()
+        if stat.st_size == offset:
+            if stat.st_mtime == mtime:
+                return None
+            log.debug('Index file rewritten. Load %s', self.path)
+            return self._reload()
+        with open(self.path) as index_file:
+            # read the last loaded byte too, to check that the lines are
+            # appended after it
+            index_file.seek(max(offset - 1, 0))
+            data = index_file.read(stat.st_size - offset + bool(offset))
+        if offset:
+            if not data.startswith('\n'):
+                log.debug('Index file rewritten. Load %s', self.path)
+                return self._reload()
+            data = data[1:]
+        # a line being written is loaded at the next poll
+        end = data.rfind('\n') + 1
+        if not end:
+            return None
+        self._polled = (device, inode, stat.st_mtime, offset + end)
+        dsid = self.format.get('id', 'id')
+        added = {}
+        # appended lines are not replayed when saving
+        journal, self._journal = self._journal, None
+        try:
+            for line in data[:end].splitlines():
+                if self._stats is not None:
+                    self._stats['lines_parsed'] += 1
+                tags = Index.parse_line(line, **self.format)
+                dataset = self.insert(**tags)
+                paths = added.setdefault(getattr(dataset, dsid), set())
+                if tags.get('path') not in EMPTY_PATHS:
+                    paths.add(tags.get('path'))
+        finally:
+            self._journal = journal
+        return self._added(added)
+
+    def _replay(self, journal):
+        """Return a new :class:`Index` loaded from the index file with the
+        changes in ``journal`` replayed"""
+        fresh = Index(format=self.format)
+        fresh.open(self.path)
+        fresh._journal = None
+        for operation, kwargs in journal or []:
+            getattr(fresh, operation)(**kwargs)
+        return fresh
+
+    def _rollback(self, state):
+        """Discard the changes made in a batch. ``state`` is the journal of
+        the changes made before the batch, or a copy of the datasets if the
+        index was not opened from a file."""
+        log.debug('Discard the changes made in the batch')
+        if isinstance(state, dict):
+            self.datasets = state
+        else:
+            fresh = self._replay(state)
+            self.datasets = fresh.datasets
+            self._version = fresh._version
+            self._polled = fresh._polled
+            self._journal = state
+        self._derived = None
+
+    def _reload(self):
+        """Load the index file again replaying the changes made to this
+        instance. Return an :class:`Index` with the datasets and files
+        added or changed. Datasets with changed metadata are returned with
+        all their files."""
+        fresh = self._replay(self._journal)
+        added = {}
+        for key, dataset in fresh.datasets.items():
+            old = self.datasets.get(key)
+            if old is None:
+                added[key] = set()
+                continue
+            paths = set(path for path, info in dataset if old[path] != info)
+            if dict(old.get_meta_items()) != dict(dataset.get_meta_items()):
+                added[key] = set()
+            elif paths:
+                added[key] = paths
+        self.datasets = fresh.datasets
+        self._derived = None
+        self._version = fresh._version
+        self._polled = fresh._polled
+        return self._added(added)
+
+    def _added(self, added):
+        """Return an :class:`Index` with the datasets and files in
+        ``added``, a dictionary of sets of paths indexed by dataset id"""
+        datasets = {}
+        for key, paths in added.items():
+            dataset = self.datasets[key]
+            if paths:
+                dataset = dataset.clone(paths)
+            datasets[key] = dataset
+        return Index(datasets=datasets, format=self.format)
+
+    def watch(self, interval=1.0, timeout=None):
+        """Watch the index file for changes. The file is checked every
+        ``interval`` seconds with :meth:`poll` and an :class:`Index` with
+        the datasets and files added is generated after each change.
+
+        :keyword interval: the number of seconds between checks. Default: 1.0
+        :keyword timeout: the number of seconds after which watching stops.
+        Default: None (watch forever)
+        """
+        start = time.time()
+        while True:
+            added = self.poll()
+            if added is not None:
+                yield added
+            if timeout is not None and \
+                    time.time() + interval - start > timeout:
+                return
+            time.sleep(interval)
+
+    def _merge(self):
+        """Merge the changes made to this instance into the index file
+        contents if the file was modified after it was opened."""
+        if self._version is None or self._version[0] != self.path:
+            return
+        opened = self._version[1]
+        current = file_version(self.path, checksum=False)
+        if current is None or current[:-1] == opened[:-1]:
+            return
+        if file_version(self.path)[-1] == opened[-1]:
+            log.debug('Index file touched but not modified')
+            return
+        if any(dataset.__dict__.get('_touched')
+               for dataset in self.datasets.itervalues()):
+            raise StoreException('The index file was modified by another '
+                                 'process and datasets were changed directly. '
+                                 'Use insert and remove to merge the changes')
+        log.info('Index file modified by another process. Merge %d changes',
+                 len(self._journal))
+        fresh = self._replay(self._journal)
+        self.datasets = fresh.datasets
+        self._derived = None
+        self._version = fresh._version
+        self._polled = fresh._polled
+        self._journal = []
+
+    @_reading
     def export(self, absolute=False, export_type='index', tags=None,
-               header=False, hide_missing=False, **kwargs):
+               header=False, hide_missing=False, sort_buffer=None, **kwargs):
         """Export the index file information. ``kwargs`` contains the format
         information.
 
@@ -295,7 +878,63 @@ class Index(object):
         false
         :keyword type: specify the export type. Values:
         ['index','tab','json']. Default: 'index'
+        :keyword sort_buffer: the maximum number of rows to be sorted in
+        memory. Larger exports are sorted using temporary files. Default:
+        None (sort all rows in memory)
+        :keyword columns: a dictionary of values added to all the rows.
+        Default: None
+        :keyword keyed: return (sort key, line) tuples instead of lines, to
+        merge sorted exports. The tab header is not keyed. Default: False
+        """
+        return list(self.iter_export(absolute=absolute,
+                                     export_type=export_type, tags=tags,
+                                     header=header, hide_missing=hide_missing,
+                                     sort_buffer=sort_buffer, **kwargs))
+
+    def iter_export(self, absolute=False, export_type='index', tags=None,
+                    header=False, hide_missing=False, sort_buffer=None,
+                    **kwargs):
+        """Same as :meth:`export` but return an iterator over the output
+        lines instead of a list. A thread-safe index is locked for reading
+        until the iterator is exhausted or closed.
         """
+        lines = self._iter_export(absolute=absolute, export_type=export_type,
+                                  tags=tags, header=header,
+                                  hide_missing=hide_missing,
+                                  sort_buffer=sort_buffer, **kwargs)
+        if self._stats is not None:
+            lines = self._timed_lines(lines)
+        if self._rwlock is None:
+            return lines
+        return self._read_locked(lines)
+
+    def _timed_lines(self, lines):
+        """Iterate over ``lines`` adding the time spent generating them to
+        the 'export' timer"""
+        timers = self._stats['time']
+        lines = iter(lines)
+        while True:
+            start = time.time()
+            try:
+                line = next(lines)
+            finally:
+                timers['export'] = timers.get('export', 0.0) + \
+                    time.time() - start
+            yield line
+
+    def _read_locked(self, lines):
+        """Iterate over ``lines`` holding the index lock for reading"""
+        token = self._rwlock.acquire_read()
+        try:
+            for line in lines:
+                yield line
+        finally:
+            self._rwlock.release_read(token)
+
+    def _iter_export(self, absolute=False, export_type='index', tags=None,
+                     header=False, hide_missing=False, sort_buffer=None,
+                     columns=None, keyed=False, **kwargs):
+        """Generate the output lines. See :meth:`iter_export`."""
         sort_by = None
         if self.format:
             log.debug('Use format from the Index instance')
@@ -323,59 +962,93 @@ class Index(object):
 
             path = idxmap.get('path', 'path')
 
-        dsets = []
-
-        for dataset in self.datasets.values():
-            for ak, addon in self.format.get('addons', {}).items(): # addon ~ 'data_type'
-                mapping = addon.get('mapping') # 'view'
-                if mapping:
-                    for k, v in dataset:
-                        if v.get(mapping) in addon:
-                            v[ak] = addon.get(v.get(mapping))
-            expd = dataset.export(tags=tags)
-            for dic in expd:
-                line = dict()
-                for k, val in dic.items():
-                    if k == 'path' and absolute:
-                        if self.path and not os.path.isabs(val):
-                            val = os.path.join(os.path.dirname(self.path),
-                                               os.path.normpath(val))
-                    if idxmap:
-                        k = idxmap.get(k, k)
-                    if k:
-                        line[k] = val
-                dsets.append(line)
-
         # default sort datasets by path if no tags specified
         if not sort_by:
             sort_by = [path]
 
+        if export_type == 'tab' and tags:
+            for line in self._iter_tab_export(tags, idxmap, absolute=absolute,
+                                              colsep=colsep, header=header,
+                                              hide_missing=hide_missing,
+                                              sort_buffer=sort_buffer,
+                                              columns=columns, keyed=keyed):
+                yield line
+            return
+
+        # collect all keys while rows are sorted
+        keys = set()
+
+        derived = self._get_derived()
+
+        def rows():
+            for dskey, dataset in self.datasets.items():
+                expd = dataset.export(tags=tags, extra=derived.get(dskey))
+                for dic in expd:
+                    line = dict()
+                    for k, val in dic.items():
+                        if k == 'path' and absolute:
+                            if self.path and not os.path.isabs(val):
+                                val = os.path.join(os.path.dirname(self.path),
+                                                   os.path.normpath(val))
+                        if idxmap:
+                            k = idxmap.get(k, k)
+                        if k:
+                            line[k] = val
+                    if columns:
+                        line.update((k, val) for k, val in columns.items()
+                                    if not tags or k in tags)
+                    keys.update(line)
+                    yield dskey, line
+
+        def sort_key(row):
+            return [row[1].get(tag) for tag in sort_by]
+
+        def emit(row, out_line):
+            if keyed:
+                return sort_key(row), out_line
+            return out_line
+
         # sort datasets
-        dsets.sort(key=lambda x: [x.get(tag) for tag in sort_by])
+        dsets = sort_rows(rows(), sort_key, buffer_size=sort_buffer)
 
         log.debug('Create output for %s format', export_type)
-        out = []
         if export_type == 'index':
-            for line in dsets:
+            serializer = TagSerializer(keymap=idxmap, **kwargs)
+            for row in dsets:
+                dskey, line = row
                 if hide_missing and not line.get(path):
                     continue
-                out.append(colsep.join([line.pop(path, '.'),
-                           to_tags(**dict(line.items() +
-                           kwargs.items()))]))
+                if keyed:
+                    row = (dskey, dict(line))
+                file_path = line.pop(path, '.')
+                meta_tags, meta = [], {}
+                if not tags:
+                    # metadata tags are serialized once per dataset
+                    meta_tags, meta = self.datasets[dskey].get_tags_list(
+                        serializer)
+                fields = []
+                for k, val in line.iteritems():
+                    if k in meta:
+                        if val == meta[k]:
+                            continue
+                        log.debug('File attribute %s overrides metadata', k)
+                        meta_tags, fields = [], line.items()
+                        break
+                    fields.append((k, val))
+                yield emit(row, colsep.join([file_path, serializer.join(
+                    meta_tags, serializer.tag_list(fields))]))
 
         if export_type == 'json':
-            for line in dsets:
-                out.append(json.dumps(line))
+            dumps = json_backend()
+            for row in dsets:
+                yield emit(row, dumps(row[1], sort_keys=True))
 
         if export_type == 'tab':
             headline = []
             if tags:
                 headline = [tag if tag != 'id' else dsid for tag in tags]
             else:
-                keys = [d.keys() for d in dsets]
-                def union(x, y):
-                    return set.union(set(x), set(y))
-                headline = list(reduce(union, keys))
+                headline = list(keys)
             def sort_header(x):
                 if not tags:
                     return x
@@ -384,7 +1057,12 @@ class Index(object):
                 return sys.maxint
 
             headline.sort(key=sort_header)
-            for line in dsets:
+            if header:
+                yield colsep.join(headline)
+            # rows are sorted, so duplicated lines have the same sort key
+            group, out = None, set()
+            for row in dsets:
+                line = row[1]
                 vals = [line.get(k, 'NA') for k in headline]
                 if tags or len(line.values()) != len(headline):
                     vals = [line.get(l, 'NA') for l in headline]
@@ -395,13 +1073,81 @@ class Index(object):
                         val = quote_tags(val)
                         vals[i] = self.format.get('rep_sep', ",").join(val)
                 else:
-                    if colsep.join(quote_tags(vals)) not in out:
-                        out.append(colsep.join(quote_tags(vals)))
-            if header:
-                out.insert(0, colsep.join(headline))
-
-        return out
+                    out_line = colsep.join(quote_tags(vals))
+                    key = sort_key(row)
+                    if key != group:
+                        group, out = key, set()
+                    if out_line not in out:
+                        out.add(out_line)
+                        yield emit(row, out_line)
+
+    def _iter_tab_export(self, tags, idxmap=None, absolute=False,
+                         colsep='\t', header=False, hide_missing=False,
+                         sort_buffer=None, columns=None, keyed=False):
+        """Generate the output lines of a tabular export of ``tags``. Only
+        the values of the requested tags are gathered, as tuples sorted in
+        the order of ``tags``. See :meth:`iter_export`."""
+        # the output columns are the mapped names of the exported tags
+        names = [idxmap.get(t, t) if idxmap else t for t in tags]
+        sources = []
+        for tag in tags:
+            source = None
+            if columns and tag in columns:
+                source = columns[tag]
+            elif tag in names:
+                source = tags[names.index(tag)]
+            sources.append(source)
+        fetch = [t for t in tags if t in sources]
+        positions = [fetch.index(s) if s in fetch else None for s in sources]
+        constants = [columns.get(t) if columns else None for t in tags]
+        if 'path' in fetch and absolute and self.path:
+            path_pos = fetch.index('path')
+        else:
+            path_pos = None
+        dirname = os.path.dirname(self.path or '')
+
+        derived = self._get_derived()
+
+        def rows():
+            for dskey, dataset in self.datasets.items():
+                for values in dataset.project(fetch, extra=derived.get(dskey)):
+                    if path_pos is not None:
+                        val = values[path_pos]
+                        if val and not os.path.isabs(val):
+                            values = list(values)
+                            values[path_pos] = os.path.join(
+                                dirname, os.path.normpath(val))
+                    yield tuple([
+                        values[pos] if pos is not None else constants[i]
+                        for i, pos in enumerate(positions)])
+
+        # the header columns are sorted by their first position in tags
+        order = sorted(range(len(tags)), key=lambda i: tags.index(tags[i]))
+        if header:
+            yield colsep.join([tags[i] for i in order])
+        rep_sep = self.format.get('rep_sep', ",")
+        last = None
+        # the rows are sorted by the values in the order of tags, so
+        # duplicated lines are consecutive
+        for row in sort_rows(rows(), tuple, buffer_size=sort_buffer):
+            vals = []
+            for i in order:
+                val = row[i]
+                if val is None:
+                    val = 'NA'
+                if hide_missing and val == "NA":
+                    break
+                if type(val) == list:
+                    val = rep_sep.join(quote_tags(val))
+                vals.append(val)
+            else:
+                out_line = colsep.join(quote_tags(vals))
+                if out_line != last:
+                    last = out_line
+                    yield (list(row), out_line) if keyed else out_line
 
+    @_reading
+    @_timed('lookup')
     def lookup(self, exact=False, or_query=False, **kwargs):
         """Select datasets from indexfile. ``kwargs`` contains the attributes
         to be looked for.
@@ -422,33 +1168,70 @@ class Index(object):
             log.debug('Query by %s', kwargs)
             if not self.datasets:
                 return self
+            dsid = self.format.get('id', 'id')
+            if kwargs.keys() == [dsid]:
+                return self._lookup_id(kwargs[dsid], exact=exact)
             datasets = {}
+            if self._stats is not None:
+                self._stats['lookups'] += 1
+                self._stats['datasets_scanned'] += len(self.datasets)
             for dsetk in self.datasets:
                 dset = self.datasets.get(dsetk)
                 if or_query:
                     for key, val in kwargs.items():
-                        if {key: val, 'exact': exact} in dset:
-                            obj = dset.dice(exact=exact, **{key: val})
-                            if obj:
-                                datasets[dsetk] = obj
-                            else:
-                                datasets[dsetk] = dset
-                kwargs['exact'] = exact
-                if kwargs in dset:
-                    obj = dset.dice(exact=exact, **kwargs)
-                    if obj:
-                        datasets[dsetk] = obj
-                    else:
-                        datasets[dsetk] = dset
+                        paths = self._match(dset, {key: val}, exact=exact)
+                        if paths is not None:
+                            datasets[dsetk] = dset.dice(paths) if paths \
+                                else dset
+                paths = self._match(dset, kwargs, exact=exact)
+                if paths is not None:
+                    datasets[dsetk] = dset.dice(paths) if paths else dset
+            if self._stats is not None:
+                self._stats['datasets_matched'] += len(datasets)
             return Index(datasets=datasets, format=self.format)
 
         return None
 
+    @staticmethod
+    def _match(dataset, query, exact=False):
+        """Match a dataset with a query. Return the list of paths of the
+        matching files, an empty list if the query matches the dataset but
+        contains no file information, or None if the dataset does not match.
+        Used by :meth:`lookup` and :meth:`remove` to match datasets the same
+        way.
+
+        :keyword exact: exact matching of values. Default: False
+        """
+        if dict(query, exact=exact) not in dataset:
+            return None
+        return dataset.match_files(exact=exact, **query) or []
+
+    def _lookup_id(self, value, exact=False):
+        """Select datasets by id. Only the dataset keys are matched, so
+        lazy datasets are not decoded. See :meth:`lookup`."""
+        if exact and isinstance(value, basestring):
+            keys = [value] if value in self.datasets else []
+        else:
+            keys = [k for k in self.datasets if match(value, k, exact=exact)]
+        if self._stats is not None:
+            self._stats['lookups'] += 1
+            self._stats['datasets_scanned'] += len(self.datasets)
+            self._stats['datasets_matched'] += len(keys)
+        return Index(datasets=dict([(k, self.datasets[k]) for k in keys]),
+                     format=self.format)
+
     def __len__(self):
         return len(self.datasets)
 
-    def lock(self):
-        """Lock this index file
+    def lock(self, shared=False, timeout=None):
+        """Lock this index file. The lock is taken on a companion file with
+        the ``.lock`` extension.
+
+        :keyword shared: specify if a shared lock has to be used. Shared locks
+        are meant for read-only operations and can be held by many processes
+        at the same time. Default: False (exclusive lock)
+        :keyword timeout: the maximum number of seconds to wait for the lock.
+        Default: None (use ``Index.lock_timeout``)
 
         """
         if self._lock is not None:
@@ -463,13 +1246,23 @@ class Index(object):
         if not os.path.exists(base):
             os.makedirs(base)
 
-        self._lock = LockFile(self.path)
+        if timeout is None:
+            timeout = self.lock_timeout
+
+        lock = FileLock('%s.lock' % self.path, shared=shared)
         try:
             log.debug('Lock indexfile %s', self.path)
-            self._lock.acquire()
-            return True
+            lock.acquire(timeout=timeout)
+            self._lock = lock
+        except StoreException:
+            raise
         except Exception, exc:
             raise StoreException("Locking index file failed: %s" % str(exc))
+        finally:
+            if lock.wait_time is not None:
+                self._lock_stats['wait'] += lock.wait_time
+        log.debug('Lock acquired in %.3fs', lock.wait_time)
+        return True
 
     def release(self):
         """Release a lock on this index file
@@ -480,9 +1273,32 @@ class Index(object):
             return False
         log.debug('Release lock %s', self._lock)
         self._lock.release()
+        log.debug('Lock held for %.3fs', self._lock.hold_time)
+        self._lock_stats['count'] += 1
+        self._lock_stats['hold'] += self._lock.hold_time
         self._lock = None
         return True
 
+    def lock_stats(self):
+        """Return a dictionary with the number of locks acquired and
+        released by this instance and the total time spent waiting for and
+        holding them."""
+        return dict(self._lock_stats)
+
+    def stats(self):
+        """Return a dictionary with the statistics collected by this
+        instance: the number of lines parsed, datasets and files inserted,
+        lookups, datasets scanned and matched by lookups, saves and bytes
+        written, and the cumulative time in seconds spent in each operation.
+        Statistics are only collected if ``Index.collect_stats`` is set when
+        the instance is created. Lock statistics are always included.
+        """
+        stats = {}
+        if self._stats is not None:
+            stats = deepcopy(self._stats)
+        stats['lock'] = self.lock_stats()
+        return stats
+
     @classmethod
     def guess_type(cls, input_file, trail=';', delimiters=None):
         """Guess type of an input file for importing data into the index.
@@ -0,0 +1,175 @@
+"""IndexSet module.
+
+The module provide a class to query many index files at once. Index files
+are loaded and queried in parallel in a process pool and the results are
+merged into a single sorted output.
+
+"""
+import os
+import glob
+import heapq
+from indexfile.index import Index
+# the command line checks index sets without loading the index modules
+from indexfile.cli import is_index_set
+
+# setup logger
+import indexfile
+# Disable warning about invalid constant name
+# pylint: disable=C0103
+log = indexfile.getLogger(__name__)
+# pylint: enable=C0103
+
+# name of the column containing the index file path of each row
+SOURCE_COLUMN = 'source'
+
+
+def expand_paths(specs):
+    """Return the sorted list of index paths matching ``specs``. ``specs``
+    is a list of paths and glob patterns, or a comma separated string."""
+    if isinstance(specs, basestring):
+        specs = specs.split(',')
+    paths = set()
+    for spec in specs:
+        matches = glob.glob(os.path.expanduser(spec))
+        if not matches and not glob.has_magic(spec):
+            matches = [spec]
+        paths.update(os.path.abspath(path) for path in matches)
+    return sorted(paths)
+
+
+def _open_index(path, idx_format):
+    """Load the index file ``path`` with the format ``idx_format``"""
+    if isinstance(idx_format, dict):
+        index = Index(format=idx_format)
+    else:
+        index = Index()
+        index.set_format(idx_format)
+    index.open(path)
+    return index
+
+
+def _query_index(job):
+    """Load an index file, query it and return the keyed export lines. Run
+    in the pool processes."""
+    path, idx_format, query, export = job
+    index = _open_index(path, idx_format)
+    result = index
+    if query:
+        result = index.lookup(**query)
+        result.path = index.path
+    return list(result.iter_export(keyed=True, **export))
+
+
+def _count_index(job):
+    """Load an index file, query it and return the number of matching
+    datasets. Run in the pool processes."""
+    path, idx_format, query = job
+    index = _open_index(path, idx_format)
+    if query:
+        index = index.lookup(**query)
+    return len(index)
+
+
+class IndexSet(object):
+    """A set of index files queried together.
+
+    Each index file is loaded and queried in a separate process. The
+    exports of all the files are merged into a single sorted stream and a
+    ``source`` column with the path of the index file is added to each row.
+    """
+
+    def __init__(self, paths, format=None, processes=None):
+        """Create an instance of an IndexSet
+
+        :param paths: a list of paths and glob patterns, or a comma
+        separated string
+        :keyword format: the index format as a dictionary, a YAML/JSON string
+        or file. Default: None (default format)
+        :keyword processes: the number of processes. Default: None (number
+        of CPUs)
+        """
+        self.paths = expand_paths(paths)
+        self.format = format
+        self.processes = processes
+        self.lock_timeout = None
+
+    def iter_export(self, query=None, tags=None, header=False, **kwargs):
+        """Query all the index files and iterate over the merged output
+        lines. See :meth:`Index.export` for the export options.
+
+        :keyword query: a dictionary with the query attributes. See
+        :meth:`Index.lookup`. Default: None (export all)
+        :keyword tags: the list of tags to be exported. The ``source`` column
+        is added as the first one. Default: None (all tags)
+        :keyword header: output the header line for 'tab' exports. Default:
+        False
+        """
+        export_type = kwargs.get('export_type', 'index')
+        if tags:
+            tags = [SOURCE_COLUMN] + [t for t in tags if t != SOURCE_COLUMN]
+        elif export_type == 'tab':
+            raise ValueError('Tags are required to export many indexes '
+                             'in tabular format')
+        if not self.paths:
+            return
+        if header and export_type == 'tab':
+            yield kwargs.get('colsep', '\t').join(tags)
+        jobs = [(path, self.format, query,
+                 dict(kwargs, tags=tags, columns={SOURCE_COLUMN: path}))
+                for path in self.paths]
+        for dummy_key, line in heapq.merge(*self._map(_query_index, jobs)):
+            yield line
+
+    def count(self, query=None):
+        """Return the number of datasets matching ``query`` in all the index
+        files, as ``len`` of the result of :meth:`Index.lookup` for a single
+        index. Datasets with the same id in different files are counted once
+        for each file.
+
+        :keyword query: a dictionary with the query attributes. Default: None
+        (count all the datasets)
+        """
+        jobs = [(path, self.format, query) for path in self.paths]
+        return sum(self._map(_count_index, jobs))
+
+    def _map(self, func, jobs):
+        """Run ``func`` on each job in the process pool and return the list
+        of results"""
+        if not jobs:
+            return []
+        import multiprocessing
+        processes = min(self.processes or multiprocessing.cpu_count(),
+                        len(jobs))
+        log.debug('Query %d indexes with %d processes', len(jobs), processes)
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                return pool.map(func, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        return [func(job) for job in jobs]
+
+    def export(self, query=None, **kwargs):
+        """Same as :meth:`iter_export` but return a list"""
+        return list(self.iter_export(query=query, **kwargs))
+
+    def lock(self, shared=False, timeout=None):
+        """Index sets are read only and are not locked"""
+        return False
+
+    def release(self):
+        """Index sets are read only and are not locked"""
+        return False
+
+    def lock_stats(self):
+        """Return empty lock statistics"""
+        return {'count': 0, 'wait': 0.0, 'hold': 0.0}
+
+    def stats(self):
+        """Return the lock statistics. Index sets do not collect other
+        statistics. See :meth:`Index.stats`."""
+        return {'lock': self.lock_stats()}
+
+    def __len__(self):
+        return len(self.paths)
@@ -0,0 +1,201 @@
+"""Server module.
+
+The module provide a server keeping indexes loaded in memory and running
+command line tools requests received over a Unix domain socket.
+
+"""
+import os
+import sys
+import errno
+import importlib
+import threading
+import SocketServer
+import simplejson as json
+from stat import S_ISDIR
+from indexfile.client import (DEFAULT_ENV_SOCKET, default_socket, socket_dir,
+                              is_owned, ping, request, write_frame,
+                              read_frames)
+
+# setup logger
+import indexfile
+# Disable warning about invalid constant name
+# pylint: disable=C0103
+log = indexfile.getLogger(__name__)
+# pylint: enable=C0103
+
+# size of the output frames sent to clients
+FRAME_SIZE = 1 << 16
+
+
+def file_signature(path):
+    """Return a cheap signature of a file to detect changes"""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return stat.st_ino, stat.st_mtime, stat.st_size
+
+
+def private_dir(path):
+    """Create the folder ``path`` only accessible by the current user, or
+    check that an existing folder is"""
+    try:
+        os.mkdir(path, 0700)
+    except OSError, exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    stat = os.lstat(path)
+    if not S_ISDIR(stat.st_mode) or stat.st_uid != os.getuid() or \
+            stat.st_mode & 0077:
+        raise ValueError('%s is not a private folder of the current user' %
+                         path)
+    return path
+
+
+class _FrameWriter(object):
+    """A file like object sending written data as frames"""
+
+    def __init__(self, wfile, kind='out'):
+        self.wfile = wfile
+        self.kind = kind
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= FRAME_SIZE:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._buffer:
+            write_frame(self.wfile, self.kind, ''.join(self._buffer))
+            self._buffer = []
+            self._size = 0
+        self.wfile.flush()
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    """Handle one command request"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # a client checking if the server is running
+            return
+        try:
+            request = json.loads(line)
+        except ValueError:
+            write_frame(self.wfile, 'err', '[ERROR] Invalid request\n')
+            write_frame(self.wfile, 'exit', '1')
+            return
+        out = _FrameWriter(self.wfile)
+        err = _FrameWriter(self.wfile, 'err')
+        status = self.server.run(request, out, err)
+        out.flush()
+        err.flush()
+        write_frame(self.wfile, 'exit', str(status))
+
+
+class IndexServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """A server keeping indexes in memory and running commands on them.
+
+    Indexes are reloaded when the index file changes. Commands are run one
+    at a time since they use the process wide standard streams, working
+    directory and arguments.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=None):
+        """Create a server listening on ``socket_path``
+
+        :keyword socket_path: the path to the socket. Default: None (use
+        :func:`default_socket`)
+        """
+        if not socket_path and DEFAULT_ENV_SOCKET not in os.environ:
+            private_dir(socket_dir())
+        self.socket_path = socket_path or default_socket()
+        if os.path.lexists(self.socket_path):
+            if not is_owned(self.socket_path):
+                raise ValueError('%s is not owned by the current user' %
+                                 self.socket_path)
+            if ping(self.socket_path):
+                raise ValueError('A server is already running on %s' %
+                                 self.socket_path)
+            os.remove(self.socket_path)
+        SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                               _RequestHandler)
+        os.chmod(self.socket_path, 0600)
+        self._indexes = {}
+        self._run_lock = threading.Lock()
+
+    def get_index(self, config):
+        """Return the index for ``config``, (re)loading it if needed"""
+        # pylint: disable=W0404
+        from indexfile.cli import open_index
+        key = (config.get('index'), config.get('format'))
+        signature = file_signature(config.get('index'))
+        index, loaded = self._indexes.get(key, (None, None))
+        if index is None or loaded != signature:
+            log.info('Load index %s', config.get('index'))
+            index = open_index(config)
+            self._indexes[key] = (index, signature)
+        return index
+
+    def run(self, request, out, err):
+        """Run a command request and return the exit status"""
+        config = request.get('config', {})
+        command = request.get('command')
+        argv = request.get('args', [])
+        name = indexfile.__name__
+        with self._run_lock:
+            stdout, stderr, sys_argv = sys.stdout, sys.stderr, sys.argv
+            cwd = os.getcwd()
+            index = None
+            status = 1
+            try:
+                os.chdir(request.get('cwd', cwd))
+                sys.stdout, sys.stderr = out, err
+                sys.argv = [name, command] + argv
+                index = self.get_index(config)
+                module = importlib.import_module(
+                    'indexfile.cli.indexfile_%s' % command)
+                module.command = '%s %s' % (name, command)
+                module.run(index)
+                status = 0
+            except SystemExit, exc:
+                if exc.code in [None, 0]:
+                    status = 0
+                elif isinstance(exc.code, int):
+                    status = exc.code
+                else:
+                    err.write('%s\n' % exc.code)
+            # pylint: disable=W0703
+            except Exception, exc:
+                err.write('[ERROR] %s\n' % exc)
+            # pylint: enable=W0703
+            finally:
+                if index is not None:
+                    index.release()
+                    key = (config.get('index'), config.get('format'))
+                    if status:
+                        # the index may have been changed in memory and
+                        # not saved: reload it from disk on the next request
+                        self._indexes.pop(key, None)
+                    elif key in self._indexes:
+                        # do not reload the index because of our own changes
+                        self._indexes[key] = (index, file_signature(
+                            config.get('index')))
+                sys.stdout, sys.stderr, sys.argv = stdout, stderr, sys_argv
+                os.chdir(cwd)
+            return status
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
@@ -0,0 +1,350 @@
+"""SQLite storage module.
+
+The module provide an :class:`Index` backend storing datasets and files
+into a local SQLite database. Queries are translated into SQL so that only
+the matching datasets are loaded.
+
+"""
+import re
+import os
+import sqlite3
+import simplejson as json
+from indexfile.utils import *
+from indexfile.index import Index
+from indexfile.dataset import Dataset
+
+# setup logger
+import indexfile
+# Disable warning about invalid constant name
+# pylint: disable=C0103
+log = indexfile.getLogger(__name__)
+# pylint: enable=C0103
+
+# name of the column referring to the dataset in the files table
+DATASET_COLUMN = '_dataset'
+# name of the column storing the list values of a dataset (replicates)
+LISTS_COLUMN = '_lists'
+
+
+def quote_name(name):
+    """Quote an SQL identifier"""
+    return '"%s"' % str(name).replace('"', '""')
+
+
+class SQLiteIndex(Index):
+    """An index stored into a SQLite database.
+
+    The database contains a ``datasets`` table with one column for each
+    metadata key and a ``files`` table with one column for each file
+    information key. Indexes are created for the dataset id, the file path
+    and type and for the tags specified by the user. The index format is
+    stored into the database.
+
+    Queries are executed in the database and only the matching datasets are
+    loaded. All the other operations load the whole index in memory.
+    """
+
+    def __init__(self, path=None, datasets=None, format=None, indexed=None):
+        """Creates an instance of a SQLiteIndex
+
+        :param path: the path to the database file
+        :keyword indexed: a list of tag names to be indexed in the
+        database. Default: None
+
+        """
+        super(SQLiteIndex, self).__init__(path=path, datasets=datasets,
+                                          format=format)
+        self.indexed = indexed or []
+        self._db = None
+        self._loaded = bool(datasets)
+
+    @classmethod
+    def create(cls, path, index, indexed=None):
+        """Create a database from an index
+
+        :param path: the path to the database file
+        :param index: an :class:`Index` instance or the path to an index file
+        :keyword indexed: a list of tag names to be indexed. Default: None
+
+        """
+        if not isinstance(index, Index):
+            index_path = index
+            index = Index()
+            index.open(index_path)
+        sqlindex = cls(format=index.format, datasets=index.datasets,
+                       indexed=indexed)
+        sqlindex.save(path)
+        return sqlindex
+
+    def open(self, path=None):
+        """Connect to a database. Data are loaded only when needed.
+
+        :param path: the path to the database file
+
+        """
+        if not path:
+            if not self.path:
+                raise AttributeError('No path sepcified')
+            path = self.path
+        if os.path.abspath(path) != self.path:
+            self.close()
+        self.path = os.path.abspath(path)
+        db = self._connect()
+        row = db.execute("SELECT value FROM info "
+                         "WHERE key = 'format'").fetchone()
+        if row:
+            log.debug('Use format from the database')
+            self.format = json.loads(row[0])
+        row = db.execute("SELECT value FROM info "
+                         "WHERE key = 'indexed'").fetchone()
+        if row and not self.indexed:
+            self.indexed = json.loads(row[0])
+        self.datasets = {}
+        self._loaded = False
+
+    def _connect(self):
+        """Open the database connection"""
+        if self._db is not None:
+            return self._db
+        log.debug('Connect to %s', self.path)
+        self._db = sqlite3.connect(self.path)
+        self._db.text_factory = str
+        self._db.create_function('idxmatch', 3, _match)
+        self._db.execute('CREATE TABLE IF NOT EXISTS info '
+                         '(key TEXT PRIMARY KEY, value TEXT)')
+        return self._db
+
+    def close(self):
+        """Close the database connection"""
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _columns(self, table):
+        """Return the column names of a table"""
+        return [row[1] for row in
+                self._db.execute('PRAGMA table_info(%s)' % quote_name(table))]
+
+    def _load(self):
+        """Load the whole database in memory"""
+        if self._loaded or not self.path:
+            return
+        log.debug('Load all datasets from %s', self.path)
+        self.datasets = self._select()
+        self._loaded = True
+
+    def _select(self, where=None, params=None, join='LEFT'):
+        """Select datasets and files from the database and return a
+        dictionary of :class:`Dataset` instances.
+        """
+        db = self._connect()
+        if not self._columns('datasets'):
+            return {}
+        dsid = self.format.get('id', 'id')
+        fileinfo = self.format.get('fileinfo', [])
+        meta_cols = self._columns('datasets')
+        file_cols = [c for c in self._columns('files') if c != DATASET_COLUMN]
+        lists_idx = meta_cols.index(LISTS_COLUMN)
+        query = 'SELECT %s FROM datasets d %s JOIN files f ON f.%s = d.%s' % (
+            ', '.join(['d.%s' % quote_name(c) for c in meta_cols] +
+                      ['f.%s' % quote_name(c) for c in file_cols]),
+            join, quote_name(DATASET_COLUMN), quote_name(dsid))
+        if where:
+            query += ' WHERE %s' % ' AND '.join(where)
+        log.debug('Execute %s with %s', query, params)
+        datasets = {}
+        nmeta = len(meta_cols)
+        for row in db.execute(query, params or []):
+            key = row[meta_cols.index(dsid)]
+            dataset = datasets.get(key)
+            if dataset is None:
+                meta = dict([(k, v) for k, v in zip(meta_cols, row[:nmeta])
+                             if v is not None and k != LISTS_COLUMN])
+                if row[lists_idx]:
+                    meta.update(json.loads(row[lists_idx]))
+                dataset = Dataset(fileinfo=fileinfo, **meta)
+                datasets[key] = dataset
+            info = dict([(k, v) for k, v in zip(file_cols, row[nmeta:])
+                         if v is not None])
+            if info.get('path'):
+                dataset.add_file(fileinfo=fileinfo, **info)
+        return datasets
+
+    def _condition(self, column, value, exact=False):
+        """Translate a query term into an SQL condition and its
+        parameters"""
+        if type(value) == list:
+            return '%s IN (%s)' % (column, ', '.join('?' * len(value))), value
+        if exact:
+            return '%s = ?' % column, [value]
+        prefix = _literal_prefix(value)
+        if prefix == value:
+            return '%s GLOB ?' % column, [value + '*']
+        if prefix:
+            # filter on the literal prefix first to use the column index
+            return '%s GLOB ? AND idxmatch(?, %s, 0)' % (column, column), [
+                prefix + '*', value]
+        return 'idxmatch(?, %s, 0)' % column, [value]
+
+    def lookup(self, exact=False, or_query=False, **kwargs):
+        """Select datasets from the database. See :meth:`Index.lookup`.
+        """
+        if self._loaded or or_query or not kwargs or not self.path:
+            self._load()
+            return super(SQLiteIndex, self).lookup(exact=exact,
+                                                   or_query=or_query, **kwargs)
+        dsid = self.format.get('id', 'id')
+        if 'id' in kwargs:
+            kwargs[dsid] = kwargs.pop('id')
+        log.debug('Query by %s', kwargs)
+        self._connect()
+        meta_cols = self._columns('datasets')
+        file_cols = self._columns('files')
+        where = []
+        params = []
+        join = 'LEFT'
+        for key, val in kwargs.items():
+            if key in meta_cols:
+                column = 'd.%s' % quote_name(key)
+            elif key in file_cols:
+                column = 'f.%s' % quote_name(key)
+                join = 'INNER'
+            else:
+                log.debug('Unknown key %s', key)
+                return Index(format=self.format)
+            # paths are always matched exactly
+            cond, values = self._condition(column, val,
+                                           exact=exact or key == 'path')
+            where.append(cond)
+            params.extend(values)
+        datasets = self._select(where, params, join)
+        return Index(datasets=datasets, format=self.format)
+
+    def insert(self, *args, **kwargs):
+        self._load()
+        return super(SQLiteIndex, self).insert(*args, **kwargs)
+
+    def remove(self, *args, **kwargs):
+        self._load()
+        return super(SQLiteIndex, self).remove(*args, **kwargs)
+
+    def find_replicates(self, **kwargs):
+        self._load()
+        return super(SQLiteIndex, self).find_replicates(**kwargs)
+
+    def iter_export(self, *args, **kwargs):
+        self._load()
+        return super(SQLiteIndex, self).iter_export(*args, **kwargs)
+
+    def to_index(self):
+        """Return an in-memory :class:`Index` with all the datasets. The
+        index can be saved in the index file format."""
+        self._load()
+        return Index(datasets=self.datasets, format=self.format)
+
+    def save(self, path=None, sort_buffer=None):
+        """Save all datasets into the database
+
+        :keyword path: the path to the database file. Default: None (use
+        the path of the instance)
+        """
+        if path and os.path.abspath(path) != self.path:
+            self.close()
+            self.path = os.path.abspath(path)
+        if not self.path:
+            raise AttributeError('No path sepcified')
+        self._load()
+        log.debug('Save %s', self.path)
+        datasets = self.datasets
+        db = self._connect()
+        dsid = self.format.get('id', 'id')
+        fileinfo = self.format.get('fileinfo', [])
+        rep_sep = self.format.get('rep_sep', ',')
+        meta_cols = set([dsid])
+        file_cols = set(['path', 'type'])
+        for dataset in datasets.values():
+            meta_cols.update(dataset.get_meta_tags())
+            for dummy_path, info in dataset:
+                file_cols.update(info.keys())
+        meta_cols = [dsid] + sorted(meta_cols.difference([dsid]))
+        file_cols = ['path', 'type'] + sorted(file_cols.difference(
+            ['path', 'type']))
+
+        def value(val):
+            if type(val) == list:
+                return rep_sep.join([str(v) for v in val])
+            return val
+
+        def lists(dataset):
+            values = dict([(k, v) for k, v in dataset.get_meta_items()
+                           if type(v) == list])
+            return json.dumps(values) if values else None
+
+        with db:
+            db.execute('DROP TABLE IF EXISTS files')
+            db.execute('DROP TABLE IF EXISTS datasets')
+            db.execute('CREATE TABLE datasets (%s)' % ', '.join(
+                ['%s TEXT PRIMARY KEY' % quote_name(dsid)] +
+                ['%s TEXT' % quote_name(c)
+                 for c in meta_cols[1:] + [LISTS_COLUMN]]))
+            db.execute('CREATE TABLE files (%s)' % ', '.join(
+                ['%s TEXT' % quote_name(c)
+                 for c in [DATASET_COLUMN] + file_cols]))
+            db.executemany('INSERT INTO datasets VALUES (%s)' % ', '.join(
+                '?' * (len(meta_cols) + 1)), (
+                    [value(dataset._metadata.get(c)) for c in meta_cols] +
+                    [lists(dataset)] for dataset in datasets.values()))
+            db.executemany('INSERT INTO files VALUES (%s)' % ', '.join(
+                '?' * (len(file_cols) + 1)), (
+                    [getattr(dataset, dsid), path] +
+                    [value(info.get(c)) for c in file_cols[1:]]
+                    for dataset in datasets.values()
+                    for path, info in dataset))
+            indexes = [('files', DATASET_COLUMN), ('files', 'path'),
+                       ('files', 'type')]
+            for tag in self.indexed:
+                if tag in meta_cols:
+                    indexes.append(('datasets', tag))
+                elif tag in file_cols:
+                    indexes.append(('files', tag))
+                else:
+                    log.warn('Cannot index unknown tag %s', tag)
+            for table, column in indexes:
+                db.execute('CREATE INDEX %s ON %s (%s)' % (
+                    quote_name('idx_%s_%s' % (table, column)),
+                    table, quote_name(column)))
+            db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                       ('format', json.dumps(self.format)))
+            db.execute('INSERT OR REPLACE INTO info VALUES (?, ?)',
+                       ('indexed', json.dumps(self.indexed)))
+
+    def __len__(self):
+        if self._loaded or not self.path:
+            return len(self.datasets)
+        self._connect()
+        if not self._columns('datasets'):
+            return 0
+        return self._db.execute('SELECT COUNT(*) FROM datasets').fetchone()[0]
+
+
+def _literal_prefix(pattern):
+    """Return the literal prefix of a regular expression"""
+    if '|' in pattern:
+        return ''
+    prefix = re.match(r'[^.^$*+?{}\[\]\\|()]*', pattern).group(0)
+    if pattern[len(prefix):len(prefix) + 1] in ['*', '?', '{']:
+        # the last character is optional
+        prefix = prefix[:-1]
+    return prefix
+
+
+def _match(pattern, value, exact):
+    """SQL function matching a value with a query term"""
+    if value is None:
+        return False
+    # SQLite passes text arguments as unicode strings
+    if type(value) == unicode:
+        value = value.encode('utf-8')
+    if type(pattern) == unicode:
+        pattern = pattern.encode('utf-8')
+    return match(pattern, value, exact=bool(exact))
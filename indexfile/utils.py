@@ -2,22 +2,85 @@
 import copy
 import re
 import os
+import time
+import errno
+import fcntl
+import heapq
+import socket
+import hashlib
+import tempfile
+import threading
+import cPickle as pickle
+from contextlib import contextmanager
+
+# setup logger
+import indexfile
+# Disable warning about invalid constant name
+# pylint: disable=C0103
+log = indexfile.getLogger(__name__)
+# pylint: enable=C0103
+
+# JSON backends in order of preference
+JSON_BACKENDS = ['ujson', 'simplejson']
+DEFAULT_ENV_JSON_BACKEND = 'IDX_JSON_BACKEND'
+
+SQLITE_HEADER = 'SQLite format 3\x00'
 
 def to_tags(kw_sep=' ', sep='=', trail=';', rep_sep=',', addons=None, quote=None, **kwargs):
     """Convert a dictionary to a string in index file format"""
-    taglist = []
-    #for k,v in kwargs.items():
-    for key, val in dict(sorted(kwargs.items(), key=lambda k: k[0])).items():
-        if addons and key in addons:
-            continue
+    serializer = TagSerializer(kw_sep=kw_sep, sep=sep, trail=trail,
+                               rep_sep=rep_sep, addons=addons)
+    return serializer.serialize(**kwargs)
+
+
+class TagSerializer(object):
+    """Convert dictionaries to strings in index file format.
+
+    A serializer is compiled once from the format information and shared
+    by all the lines of an export. Lines are built by merging sorted lists
+    of serialized tags, so that the tags common to many lines (e.g. the
+    dataset metadata) can be serialized only once.
+    """
+
+    def __init__(self, kw_sep=' ', sep='=', trail=';', rep_sep=',',
+                 addons=None, quote=None, keymap=None, **kwargs):
+        """Create a serializer. ``kwargs`` contains tags to be added to
+        every line.
+
+        :keyword keymap: a dictionary used to rename metadata keys
+        """
+        self.kw_sep = kw_sep
+        self.sep = sep
+        self.trail = trail
+        self.rep_sep = rep_sep
+        self.addons = addons or {}
+        self.keymap = keymap
+        self.key = (kw_sep, sep, trail, rep_sep, tuple(sorted(self.addons)),
+                    tuple(sorted(keymap.items())) if keymap else None)
+        self.constant = self.tag_list(kwargs.items())
+
+    def tag(self, key, val):
+        """Serialize a single key/value pair"""
         if type(val) == list:
-            val = rep_sep.join([
+            val = self.rep_sep.join([
                 quote_tags([key, value])[1] for value in val])
         else:
             val = str(val)
             key, val = quote_tags([key, val])
-        taglist.append('%s%s%s%s' % (key, sep, val, trail))
-    return kw_sep.join(sorted(taglist))
+        return '%s%s%s%s' % (key, self.sep, val, self.trail)
+
+    def tag_list(self, items):
+        """Return the sorted list of serialized key/value pairs"""
+        return sorted([self.tag(key, val) for key, val in items
+                       if key not in self.addons])
+
+    def join(self, *tag_lists):
+        """Join sorted lists of serialized tags into a line"""
+        return self.kw_sep.join(heapq.merge(self.constant, *tag_lists))
+
+    def serialize(self, **kwargs):
+        """Convert a dictionary to a string in index file format"""
+        return self.join(self.tag_list(kwargs.items()))
 
 
 def quote_tags(strings, force=False):
@@ -77,6 +140,530 @@ def map_path(pathd, template):
     return d
 
 
+def sort_rows(rows, key, buffer_size=None, tmpdir=None):
+    """Sort ``rows`` using ``key`` and return an iterator over the sorted
+    rows. The input is fully consumed before returning.
+
+    :keyword buffer_size: the maximum number of rows to be kept in memory.
+    When exceeded, sorted runs of rows are spilled to temporary files and
+    k-way merged while iterating the result. Default: None (sort in memory)
+    :keyword tmpdir: the directory for the temporary files. Default: None
+    (system default)
+
+    """
+    if not buffer_size:
+        return iter(sorted(rows, key=key))
+    runs = []
+    buf = []
+    for row in rows:
+        buf.append(row)
+        if len(buf) >= buffer_size:
+            runs.append(_spill_run(buf, key, tmpdir))
+            buf = []
+    buf.sort(key=key)
+    if not runs:
+        return iter(buf)
+    return _merge_runs(runs + [buf], key)
+
+
+def _spill_run(rows, key, tmpdir=None):
+    """Sort rows and write them to a temporary file"""
+    rows.sort(key=key)
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    for row in rows:
+        pickle.dump(row, run, pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    """Iterate over rows stored in a run"""
+    if isinstance(run, list):
+        for row in run:
+            yield row
+        return
+    try:
+        while True:
+            yield pickle.load(run)
+    except EOFError:
+        run.close()
+
+
+def _merge_runs(runs, key):
+    """Merge sorted runs. Rows with the same key keep the input order."""
+    def decorate(i, run):
+        for j, row in enumerate(_read_run(run)):
+            yield key(row), i, j, row
+    merged = heapq.merge(*[decorate(i, r) for i, r in enumerate(runs)])
+    for dummy_key, dummy_i, dummy_j, row in merged:
+        yield row
+
+
+def file_version(path, checksum=True):
+    """Return a tuple with device, inode, modification time, size and MD5
+    checksum of a file, or None if the file does not exist.
+
+    :keyword checksum: specify if the checksum has to be computed. Default:
+    True
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    md5 = None
+    if checksum:
+        md5 = hashlib.md5()
+        with open(path, 'rb') as in_file:
+            for chunk in iter(lambda: in_file.read(1 << 20), ''):
+                md5.update(chunk)
+        md5 = md5.hexdigest()
+    return stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size, md5
+
+
+class ChecksumFile(object):
+    """A file object wrapper computing the MD5 checksum of the data read,
+    so that the version of a file can be computed while reading it.
+    """
+
+    def __init__(self, in_file):
+        """Wrap the file object ``in_file`` opened for reading"""
+        self.file = in_file
+        self.name = in_file.name
+        self._md5 = hashlib.md5()
+        # the checksum is valid if the file is read from the beginning
+        self._valid = in_file.tell() == 0
+
+    def __iter__(self):
+        # read large blocks, hashing each block once
+        pending = ''
+        for block in iter(lambda: self.file.read(1 << 16), ''):
+            self._md5.update(block)
+            lines = (pending + block).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        self._md5.update(data)
+        return data
+
+    def readline(self, *args):
+        line = self.file.readline(*args)
+        self._md5.update(line)
+        return line
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.file.seek(offset, whence)
+        self._md5 = hashlib.md5()
+        self._valid = self.file.tell() == 0
+
+    def tell(self):
+        return self.file.tell()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def version(self):
+        """Return the version of the file as :func:`file_version`. The file
+        is read up to the end to complete the checksum."""
+        position = self.file.tell()
+        if not self._valid:
+            self.seek(0)
+        for chunk in iter(lambda: self.file.read(1 << 20), ''):
+            self._md5.update(chunk)
+        self.file.seek(position)
+        stat = os.fstat(self.file.fileno())
+        return (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size,
+                self._md5.hexdigest())
+
+
+def is_generational(path):
+    """Return True if ``path`` is a link to one of its generation files"""
+    if not os.path.islink(path):
+        return False
+    target = os.readlink(path)
+    return os.path.dirname(target) == '' and re.match(
+        r'^%s\.gen\d+$' % re.escape(os.path.basename(path)), target) is not None
+
+
+def generation_number(path):
+    """Return the number of the current generation of ``path``, or 0 if
+    ``path`` is not a link to one of its generation files"""
+    if not is_generational(path):
+        return 0
+    return int(os.readlink(path).rsplit('.gen', 1)[1])
+
+
+def swap_generation(path, new_file):
+    """Make ``new_file`` the current generation of ``path``. The file is
+    renamed to the next generation file and ``path`` is atomically replaced
+    with a link to it. Old generation files not in use are then removed.
+    The caller must hold an exclusive lock on the index.
+
+    :param path: the path to the index file
+    :param new_file: the path to the new contents of the index
+    """
+    path = os.path.abspath(path)
+    dirname, basename = os.path.split(path)
+    number = generation_number(path) + 1
+    generation = '%s.gen%d' % (basename, number)
+    os.rename(new_file, os.path.join(dirname, generation))
+    link = os.path.join(dirname, '.%s.link.%d' % (basename, os.getpid()))
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(generation, link)
+    os.rename(link, path)
+    log.debug('Current generation of %s is %d', path, number)
+    collect_generations(path)
+
+
+def collect_generations(path):
+    """Remove the old generation files of ``path`` not opened by any
+    reader. Return the list of removed files.
+
+    Generations are removed from the oldest one up to the first one still
+    in use, so that the remaining generations are always numbered
+    consecutively up to the current one and can be found without listing
+    the directory.
+    """
+    path = os.path.abspath(path)
+    number = generation_number(path)
+    older = []
+    while number > 1 and os.path.lexists('%s.gen%d' % (path, number - 1)):
+        number -= 1
+        older.append('%s.gen%d' % (path, number))
+    removed = []
+    for gen_file in reversed(older):
+        try:
+            gen_fd = os.open(gen_file, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            fcntl.flock(gen_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, exc:
+            if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            log.debug('Generation %s in use', gen_file)
+            break
+        else:
+            os.remove(gen_file)
+            removed.append(gen_file)
+        finally:
+            os.close(gen_fd)
+    return removed
+
+
+@contextmanager
+def open_snapshot(path):
+    """Open the file ``path`` for reading. If ``path`` is a link to a
+    generation file, the generation is locked shared while the file is open
+    so that it is not removed by :func:`collect_generations`. The name of
+    the yielded file object is the resolved path."""
+    while True:
+        real_path = os.path.realpath(path)
+        try:
+            in_file = open(real_path, 'r')
+        except IOError, exc:
+            # the generation was replaced and removed in the meantime
+            if exc.errno == errno.ENOENT and real_path != os.path.realpath(path):
+                continue
+            raise
+        break
+    try:
+        if os.path.islink(path):
+            fcntl.flock(in_file, fcntl.LOCK_SH)
+        yield in_file
+    finally:
+        in_file.close()
+
+
+def is_sqlite(path):
+    """Return True if ``path`` is a SQLite database file"""
+    try:
+        with open(path, 'rb') as db_file:
+            return db_file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except (IOError, TypeError):
+        return False
+
+
+def json_backend(name=None):
+    """Return the ``dumps`` function of the given JSON backend. If no name
+    is specified, the ``IDX_JSON_BACKEND`` environment variable is used or
+    the first installed backend in ``JSON_BACKENDS``.
+
+    :keyword name: the backend name. Default: None
+    """
+    names = [name or os.environ.get(DEFAULT_ENV_JSON_BACKEND)]
+    if not names[0]:
+        names = JSON_BACKENDS
+    for backend in names:
+        if backend not in JSON_BACKENDS:
+            raise ValueError('Unknown JSON backend %r' % backend)
+        try:
+            module = __import__(backend)
+        except ImportError:
+            continue
+        # all the backends write the same compact output
+        if backend == 'ujson':
+            return lambda obj, **kwargs: module.dumps(
+                obj, escape_forward_slashes=False, **kwargs)
+        return lambda obj, **kwargs: module.dumps(
+            obj, separators=(',', ':'), **kwargs)
+    raise ImportError('No JSON backend available')
+
+
+class StoreException(Exception):
+    """Exception raised when accessing the index storage fails"""
+
+
+class LockTimeout(StoreException):
+    """Exception raised when a lock cannot be acquired in time"""
+
+
+class FileLock(object):
+    """A reader/writer lock based on ``flock`` locks on a lock file.
+
+    Any number of shared locks can be held at the same time, while an
+    exclusive lock excludes all the other locks. Exclusive holders write
+    their pid and host name into the lock file, so that locks held on behalf
+    of dead processes (e.g. inherited by orphan child processes) can be
+    reported. Locks are never broken: the kernel releases them when the
+    last process holding them exits.
+    """
+
+    def __init__(self, path, shared=False):
+        """Create a lock
+
+        :param path: the path to the lock file
+        :keyword shared: specify if a shared lock has to be used. Default:
+        False (exclusive lock)
+        """
+        self.path = path
+        self.shared = shared
+        self.wait_time = None
+        self.hold_time = None
+        self._fd = None
+        self._acquired = None
+
+    def acquire(self, timeout=None, delay=0.01, max_delay=1.0):
+        """Acquire the lock. Retry with exponential backoff until the lock
+        is available.
+
+        :keyword timeout: the maximum number of seconds to wait. Default:
+        None (wait forever)
+        :keyword delay: the initial delay between attempts in seconds
+        :keyword max_delay: the maximum delay between attempts in seconds
+        """
+        if self._fd is not None:
+            return
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        start = time.time()
+        reported = False
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            except IOError, exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+                if not reported:
+                    reported = self._report_dead_holder(fd)
+                os.close(fd)
+                if timeout is not None and time.time() - start >= timeout:
+                    self.wait_time = time.time() - start
+                    raise LockTimeout('Timeout acquiring lock %s after %.2fs '
+                                      '(held by %s)' % (self.path, timeout,
+                                                        self.holder() or
+                                                        'unknown'))
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+                continue
+            if not self._same_file(fd):
+                # the lock file was removed while waiting
+                os.close(fd)
+                continue
+            break
+        self._fd = fd
+        self._acquired = time.time()
+        self.wait_time = self._acquired - start
+        self.hold_time = None
+        if not self.shared:
+            os.ftruncate(fd, 0)
+            os.write(fd, '%d@%s\n' % (os.getpid(), socket.gethostname()))
+
+    def release(self):
+        """Release the lock"""
+        if self._fd is None:
+            return
+        if not self.shared:
+            os.ftruncate(self._fd, 0)
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+        self.hold_time = time.time() - self._acquired
+
+    def is_locked(self):
+        """Return True if the lock is held by this instance"""
+        return self._fd is not None
+
+    def holder(self):
+        """Return the pid and host of the exclusive lock holder as a tuple,
+        or None if unknown"""
+        try:
+            with open(self.path) as lock_file:
+                return _parse_holder(lock_file.read())
+        except IOError:
+            return None
+
+    def _same_file(self, fd):
+        """Return True if ``fd`` refers to the current lock file"""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        fstat = os.fstat(fd)
+        return (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino)
+
+    def _report_dead_holder(self, fd):
+        """Log a warning if the lock holder recorded in the lock file is a
+        dead process on this host. The lock is then held by another process,
+        e.g. a child process which inherited it. Return True if a warning
+        was logged."""
+        os.lseek(fd, 0, os.SEEK_SET)
+        holder = _parse_holder(os.read(fd, 1024))
+        if not holder or holder[1] != socket.gethostname():
+            return False
+        try:
+            os.kill(holder[0], 0)
+        except OSError, exc:
+            if exc.errno == errno.ESRCH:
+                log.warn('Lock %s is held on behalf of the dead process '
+                         '%d@%s. It is released when the processes that '
+                         'inherited it exit', self.path, holder[0], holder[1])
+                return True
+        return False
+
+    def __repr__(self):
+        return "<FileLock: %r (%s)>" % (
+            self.path, 'shared' if self.shared else 'exclusive')
+
+
+def _parse_holder(string):
+    """Parse the holder information from a lock file"""
+    match_ = re.match(r'^(?P<pid>\d+)@(?P<host>\S+)', string)
+    if not match_:
+        return None
+    return int(match_.group('pid')), match_.group('host')
+
+
+class RWLock(object):
+    """A readers-writer lock for threads.
+
+    Many threads can hold the lock for reading at the same time, while a
+    writer holds it exclusively. Waiting writers are preferred over new
+    readers. The lock is reentrant: a thread holding it can acquire it again
+    for reading, and a writer can also acquire it for reading. Upgrading a
+    read lock to a write lock is not supported.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting = 0
+
+    def acquire_read(self):
+        """Acquire the lock for reading. Return a token to be passed to
+        :meth:`release_read` when the lock is released from another thread.
+        """
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writes += 1
+                return me
+            if me not in self._readers:
+                while self._writer is not None or self._waiting:
+                    self._cond.wait()
+            self._readers[me] = self._readers.get(me, 0) + 1
+            return me
+
+    def release_read(self, token=None):
+        """Release a read lock
+
+        :keyword token: the value returned by :meth:`acquire_read`. Default:
+        None (the current thread)
+        """
+        token = token or threading.current_thread()
+        with self._cond:
+            if self._writer is token:
+                self._release_write()
+                return
+            count = self._readers.get(token)
+            if not count:
+                raise RuntimeError('Release of an unlocked RWLock')
+            if count == 1:
+                del self._readers[token]
+                self._cond.notify_all()
+            else:
+                self._readers[token] = count - 1
+
+    def acquire_write(self):
+        """Acquire the lock for writing"""
+        me = threading.current_thread()
+        with self._cond:
+            if self._writer is me:
+                self._writes += 1
+                return
+            if me in self._readers:
+                raise RuntimeError('Cannot upgrade a read lock')
+            self._waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting -= 1
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        """Release a write lock"""
+        with self._cond:
+            if self._writer is not threading.current_thread():
+                raise RuntimeError('Release of an unlocked RWLock')
+            self._release_write()
+
+    def _release_write(self):
+        """Release one level of write lock. Must be called holding the
+        condition."""
+        self._writes -= 1
+        if not self._writes:
+            self._writer = None
+            self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        """Context manager holding the lock for reading"""
+        token = self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read(token)
+
+    @contextmanager
+    def writing(self):
+        """Context manager holding the lock for writing"""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
 class DotDict(dict):
     """Extends python dictionary allowing attribute access"""
     def __init__(self, *args, **kwargs):
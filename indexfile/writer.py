@@ -0,0 +1,203 @@
+"""Writer module.
+
+The module provide a class to queue changes to an index file from many
+threads and write them in batches.
+
+"""
+import os
+import time
+import threading
+
+# setup logger
+import indexfile
+# Disable warning about invalid constant name
+# pylint: disable=C0103
+log = indexfile.getLogger(__name__)
+# pylint: enable=C0103
+
+
+class IndexWriter(object):
+    """Queue insertions and removals for an :class:`Index` and apply them in
+    batches from a background thread.
+
+    Each batch locks the index, applies the queued changes and saves the
+    index once. A batch is written when ``batch_size`` changes are queued or
+    when the oldest queued change is ``interval`` seconds old. A change
+    queued again for the same dataset and file is written only once. If a
+    batch cannot be written its changes are kept in the queue and written
+    again after ``interval`` seconds.
+
+    The writer can be used as a context manager: the background thread is
+    started when entering the context and all pending changes are written
+    when leaving it.
+    """
+
+    def __init__(self, index, batch_size=100, interval=5.0):
+        """Create a writer
+
+        :param index: the :class:`Index` instance. It must have a path.
+        :keyword batch_size: the number of queued changes triggering a
+        write. Default: 100
+        :keyword interval: the maximum number of seconds a change is kept in
+        the queue. Default: 5.0
+        """
+        self.index = index
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = []
+        # position in the queue of the last change of each dataset and file
+        self._pending = {}
+        self._queued_since = None
+        self._retrying = False
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._error = None
+
+    def insert(self, **kwargs):
+        """Queue an insertion. See :meth:`Index.insert`."""
+        self._put('insert', kwargs)
+
+    def remove(self, **kwargs):
+        """Queue a removal. See :meth:`Index.remove`."""
+        self._put('remove', kwargs)
+
+    def _put(self, operation, kwargs):
+        """Add an operation to the queue"""
+        self._raise_error()
+        with self._cond:
+            if self._closed:
+                raise ValueError('IndexWriter is closed')
+            item = (operation, kwargs)
+            dsid = kwargs.get('id', kwargs.get(self.index.format.get('id')))
+            key = (dsid, kwargs.get('path'))
+            last = self._pending.get(key)
+            if last is not None and self._queue[last] == item:
+                log.debug('Coalesce duplicated %s', operation)
+                return
+            if dsid is None:
+                self._pending.clear()
+            elif operation == 'remove' or key[1] is None:
+                # the change can affect all the files of the dataset
+                for pending in self._pending.keys():
+                    if pending[0] == dsid:
+                        del self._pending[pending]
+            else:
+                self._pending.pop((dsid, None), None)
+            self._pending[key] = len(self._queue)
+            if not self._queue:
+                self._queued_since = time.time()
+            self._queue.append(item)
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+
+    def start(self):
+        """Start the background thread"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._closed = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='IndexWriter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        """Background thread loop"""
+        while True:
+            with self._cond:
+                while not self._closed and not self._ready():
+                    timeout = None
+                    if self._queue:
+                        timeout = max(0, self._queued_since + self.interval -
+                                      time.time())
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            # pylint: disable=W0703
+            except Exception, exc:
+                log.error('Writing index failed: %s', exc)
+                self._error = exc
+            # pylint: enable=W0703
+
+    def _ready(self):
+        """Return True if a batch has to be written"""
+        if not self._queue:
+            return False
+        if len(self._queue) >= self.batch_size and not self._retrying:
+            return True
+        return time.time() - self._queued_since >= self.interval
+
+    def flush(self):
+        """Write all queued changes to the index file. Return the number of
+        changes written. If writing fails the changes are put back in the
+        queue."""
+        with self._flush_lock:
+            with self._cond:
+                batch = self._queue
+                self._queue = []
+                self._pending = {}
+                self._queued_since = None
+            if not batch:
+                return 0
+            log.debug('Write %d changes to %s', len(batch), self.index.path)
+            try:
+                self._write(batch)
+            except:
+                with self._cond:
+                    self._queue[:0] = batch
+                    self._pending = {}
+                    self._queued_since = time.time()
+                    self._retrying = True
+                raise
+            self._retrying = False
+            return len(batch)
+
+    def _write(self, batch):
+        """Apply a batch of changes to the index and save it"""
+        index = self.index
+        locked = index.lock()
+        try:
+            if index._version is None and os.path.exists(index.path):
+                # load the index file, not to overwrite its contents
+                log.debug('Open %s', index.path)
+                index.open()
+            # if saving fails the changes are applied again with the next
+            # batch, which gives the same result as applying them once
+            for operation, kwargs in batch:
+                getattr(index, operation)(**dict(kwargs))
+            index.save()
+        finally:
+            if locked:
+                index.release()
+
+    def close(self):
+        """Stop the background thread and write all pending changes"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            thread.join()
+        self.flush()
+        self._raise_error()
+
+    def _raise_error(self):
+        """Raise the last error occurred in the background thread"""
+        if self._error is not None:
+            exc, self._error = self._error, None
+            raise exc
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -46,7 +46,6 @@ setup(
                       "docopt>=0.6.1",
                       "schema>=0.3.1",
                       "simplejson>=3.3.2",
-                      "lockfile>=0.9.1",
                       "PyYAML>=3.11"],
     entry_points={
         'console_scripts': [
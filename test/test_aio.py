@@ -0,0 +1,63 @@
+"""Unit test for the asynchronous index wrapper"""
+import shutil
+import pytest
+from indexfile.aio import AsyncIndex
+
+
+@pytest.fixture
+def aindex(tmpdir):
+    """An asynchronous index on a copy of the test index"""
+    path = str(tmpdir.join('index.txt'))
+    shutil.copy('test/data/index.txt', path)
+    i = AsyncIndex(path)
+    i.index.set_format('test/data/format.json')
+    return i
+
+
+def test_open_lookup(aindex):
+    """Load and query the index asynchronously"""
+    results = []
+    aindex.open(callback=results.append).get(10)
+    assert len(aindex) == 36
+    assert results == [None]
+    result = aindex.lookup(id='WWP.1').get(10)
+    assert len(result) == 1
+    assert isinstance(result, AsyncIndex)
+
+
+def test_export(aindex):
+    """Stream the exported lines"""
+    aindex.open().get(10)
+    with aindex.export(max_lines=2) as lines:
+        streamed = list(lines)
+    assert streamed == aindex.index.export()
+    lines = aindex.export(max_lines=1)
+    assert lines.get(10) == streamed[0]
+    lines.close()
+    pytest.raises(StopIteration, lines.get)
+
+
+def test_export_abandoned(aindex):
+    """Stop producing lines for a stream no longer used"""
+    aindex.open().get(10)
+    lines = aindex.export(max_lines=1)
+    assert lines.get(10)
+    thread = lines._thread
+    del lines
+    thread.join(10)
+    assert not thread.is_alive()
+    # the index is not left locked
+    assert aindex.lookup(id='WWP.1').get(10)
+
+
+def test_save_lock(aindex, tmpdir):
+    """Lock and save the index asynchronously"""
+    aindex.open().get(10)
+    assert aindex.lock().get(10)
+    aindex.index.remove(id='WWP.1')
+    aindex.save().get(10)
+    assert aindex.release()
+    other = AsyncIndex(str(tmpdir.join('index.txt')))
+    other.index.set_format('test/data/format.json')
+    other.open().get(10)
+    assert len(other) == 35
@@ -123,3 +123,267 @@ def test_add_multiple_files(tmpdir):
     out = Popen(command_line, stdout=PIPE, shell=True).communicate()[0]
 
     assert out == expected
+
+
+def test_add_delimiter(tmpdir):
+    """ Test adding files from lists with different delimiters """
+    idxfile = '%s/index.txt' % tmpdir
+    filelist = '%s/list.txt' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+
+    # values are separated by whitespace by default
+    with open(filelist, 'w+') as fli:
+        fli.write('b.txt 2\ttxt\n\nc.txt  3 txt\n')
+    assert call('idxtools add -a path,id,type -l %s' % filelist,
+                shell=True) == 0
+    with open(filelist, 'w+') as fli:
+        fli.write('d.txt,4,"a, b"\n')
+    assert call('idxtools add -d comma -a path,id,desc -l %s' % filelist,
+                shell=True) == 0
+
+    assert open(idxfile).read() == ('a.txt\tid=1; type=txt;\n'
+                                    'b.txt\tid=2; type=txt;\n'
+                                    'c.txt\tid=3; type=txt;\n'
+                                    'd.txt\tdesc="a, b"; id=4; type=txt;\n')
+
+
+def test_generations(tmpdir):
+    """ Test saving the index as generation files """
+    idxfile = '%s/index.txt' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+
+    call('idxtools --generations add id=2 path=b.txt type=txt', shell=True)
+    assert os.readlink(idxfile) == 'index.txt.gen1'
+    call('idxtools add id=3 path=c.txt type=txt', shell=True)
+    assert os.readlink(idxfile) == 'index.txt.gen2'
+    assert not os.path.exists('%s.gen1' % idxfile)
+
+
+def test_remove_from_file(tmpdir):
+    """ Test removal of files listed in a file """
+    idxfile = '%s/index.txt' % tmpdir
+    rmlist = '%s/rm.txt' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+        i.write('b.txt\tid=1; type=txt;\n')
+        i.write('c.txt\tid=2; type=txt;\n')
+    with open(rmlist, 'w+') as rml:
+        rml.write('a.txt\nid=2\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+
+    call('idxtools rm --from-file %s' % rmlist, shell=True)
+
+    assert open(idxfile).read() == 'b.txt\tid=1; type=txt;\n'
+
+
+def test_batch(tmpdir):
+    """ Test running many commands in a batch """
+    idxfile = '%s/index.txt' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+        i.write('b.txt\tid=2; type=txt;\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+
+    script = 'rm -c a.txt\nadd id=3 path=c.txt type=txt  # comment\nshow -c\n'
+    proc = Popen('idxtools batch', shell=True, stdin=PIPE, stdout=PIPE)
+    assert proc.communicate(script)[0] == '2\n'
+    assert proc.returncode == 0
+    assert open(idxfile).read() == ('b.txt\tid=2; type=txt;\n'
+                                    'c.txt\tid=3; type=txt;\n')
+
+    # nothing is saved if a command fails
+    proc = Popen('idxtools batch', shell=True, stdin=PIPE, stderr=PIPE)
+    proc.communicate('rm b.txt\nshow --unknown\n')
+    assert proc.returncode == 1
+    assert 'b.txt' in open(idxfile).read()
+
+
+def test_show_watch(tmpdir):
+    """ Test watching the counts of an index file """
+    import time
+    idxfile = '%s/index.txt' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; cell=A; type=txt;\n'
+                'b.txt\tid=2; cell=B; type=txt;\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+
+    def wait(out, expected):
+        for dummy in range(100):
+            if os.path.exists(out) and open(out).read() == expected:
+                break
+            time.sleep(0.1)
+        return open(out).read()
+
+    datasets = '%s/datasets.txt' % tmpdir
+    lines = '%s/lines.txt' % tmpdir
+    procs = [Popen('exec idxtools show -w --interval 0.05 -c -o %s cell=A'
+                   % datasets, shell=True),
+             Popen('exec idxtools show -w --interval 0.05 -c -t cell -o %s'
+                   % lines, shell=True)]
+    try:
+        assert wait(datasets, '1\n') == '1\n'
+        assert wait(lines, '2\n') == '2\n'
+        # appended lines
+        with open(idxfile, "a") as i:
+            i.write('c.txt\tid=3; cell=C; type=txt;\n')
+        assert wait(lines, '2\n3\n') == '2\n3\n'
+        # a replaced file, with a dataset not matching any more
+        with open('%s.tmp' % idxfile, "w+") as i:
+            i.write('a.txt\tid=1; cell=B; type=txt;\n'
+                    'b.txt\tid=2; cell=B; type=txt;\n'
+                    'c.txt\tid=3; cell=C; type=txt;\n')
+        os.rename('%s.tmp' % idxfile, idxfile)
+        assert wait(datasets, '1\n0\n') == '1\n0\n'
+        assert wait(lines, '2\n3\n2\n') == '2\n3\n2\n'
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+
+
+def test_batch_serve(tmpdir):
+    """ Test a failing batch run on a server """
+    import time
+    idxfile = '%s/index.txt' % tmpdir
+    script = '%s/script.txt' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+        i.write('b.txt\tid=2; type=txt;\n')
+    with open(script, "w+") as s:
+        s.write('rm a.txt\nshow --unknown\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+    env['IDX_SOCKET'] = '%s/idx.sock' % tmpdir
+
+    server = Popen('exec idxtools serve', shell=True)
+    try:
+        for dummy in range(100):
+            if os.path.exists(env['IDX_SOCKET']):
+                break
+            time.sleep(0.05)
+        proc = Popen('idxtools batch %s' % script, shell=True, stderr=PIPE)
+        proc.communicate()
+        assert proc.returncode == 1
+        assert 'a.txt' in open(idxfile).read()
+        out = Popen('idxtools show', shell=True, stdout=PIPE).communicate()[0]
+        assert out == ('a.txt\tid=1; type=txt;\n'
+                       'b.txt\tid=2; type=txt;\n')
+        # session options are applied running the command locally
+        out, err = Popen('idxtools --stats show -c', shell=True, stdout=PIPE,
+                         stderr=PIPE).communicate()
+        assert out == '2\n'
+        assert '"lock"' in err
+    finally:
+        server.terminate()
+        server.wait()
+        env.pop('IDX_SOCKET')
+
+
+def test_profile(tmpdir):
+    """ Test the profile report """
+    idxfile = '%s/index.txt' % tmpdir
+    dump = '%s/idx.prof' % tmpdir
+    with open(idxfile, "w+") as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = idxfile
+
+    command_line = 'idxtools --profile-dump %s show id=1' % dump
+    out, err = Popen(command_line, stdout=PIPE, stderr=PIPE,
+                     shell=True).communicate()
+
+    assert out == 'a.txt\tid=1; type=txt;\n'
+    phases = [line.split()[1] for line in err.splitlines()
+              if line.startswith('[profile]')]
+    # profiled commands are not run by the server
+    assert phases[:5] == ['config', 'open', 'show', 'lookup', 'export']
+    assert 'peak' in phases
+    assert os.path.exists(dump)
+
+
+def test_commands_table():
+    """ The command table matches the command modules """
+    import glob
+    import importlib
+    from indexfile.cli import COMMANDS
+    basedir = os.path.dirname(im.__file__)
+    modules = [os.path.basename(m)[:-3] for m in glob.glob(basedir + '/*.py')]
+    modules = [m for m in modules if m not in ['__init__', 'indexfile_main']]
+    assert sorted(COMMANDS) == sorted(m.replace('indexfile_', '')
+                                      for m in modules)
+    for mod in modules:
+        cmd = importlib.import_module('indexfile.cli.%s' % mod)
+        assert COMMANDS[cmd.name.split('.')[-1]] == {'desc': cmd.desc,
+                                      'aliases': cmd.aliases}
+
+
+def test_find_config(tmpdir):
+    """ Test configuration discovery and caching """
+    from indexfile.cli import find_config, read_config
+    configfile = str(tmpdir.join('.indexfile.yml'))
+    with open(configfile, 'w+') as cfg:
+        cfg.write("index: one.txt\n")
+    project = tmpdir.mkdir('project')
+    _dir = project.mkdir('dir1')
+    assert find_config(str(_dir)) == configfile
+
+    # do not look above project directories
+    project.mkdir('.git')
+    assert find_config(str(_dir)) is None
+
+    assert read_config(configfile) == {'index': 'one.txt'}
+    with open(configfile, 'w+') as cfg:
+        cfg.write("index: two.txt\n")
+    os.utime(configfile, (0, 0))
+    assert read_config(configfile) == {'index': 'two.txt'}
+
+
+def test_count_index_set(tmpdir):
+    """ Count the datasets of many indexes """
+    for name in ['a', 'b']:
+        with open('%s/%s.txt' % (tmpdir, name), 'w+') as i:
+            i.write('%s1.txt\tid=%s; type=txt;\n' % (name, name))
+            i.write('%s2.txt\tid=%s; type=txt;\n' % (name, name))
+    env.pop('IDX_FORMAT', None)
+    env['IDX_FILE'] = '%s/*.txt' % tmpdir
+
+    out = Popen('idxtools show -c', shell=True, stdout=PIPE).communicate()[0]
+    assert out == '2\n'
+    out = Popen('idxtools show -c id=a', shell=True,
+                stdout=PIPE).communicate()[0]
+    assert out == '1\n'
+
+
+def test_open_index_shared(tmpdir):
+    """ Lock the index file shared while loading it """
+    import pytest
+    from indexfile.cli import open_index
+    from indexfile.index import Index
+    from indexfile.utils import LockTimeout
+    idxfile = '%s/index.txt' % tmpdir
+    with open(idxfile, 'w+') as i:
+        i.write('a.txt\tid=1; type=txt;\n')
+    config = {'index': idxfile, 'format': None, 'locktimeout': 0.1}
+
+    writer = Index(idxfile)
+    writer.lock()
+    with pytest.raises(LockTimeout):
+        open_index(config, shared=True)
+    assert len(open_index(config)) == 1
+    writer.release()
+
+    index = open_index(config, shared=True)
+    assert len(index) == 1
+    assert index.lock_timeout == 0.1
+    # the lock is only held while loading
+    assert index.lock()
+    index.release()
@@ -398,6 +398,21 @@ def test_export_one_tag():
         assert dic.get('type') is None
 
 
+def test_project():
+    """Export tag values of dataset files as tuples"""
+    info = {'id': '1', 'path': 'test.txt', 'type': 'txt', 'view': 'text'}
+    # Disable warning about * magic
+    # pylint: disable=W0142
+    dataset = Dataset(**info)
+    # pylint: enable=W0142
+    dataset.add_file(path='test.jpg', type='jpg', view='jpeg')
+    rows = dataset.project(['path', 'id', 'size', '{basename}'],
+                           extra={'test.jpg': {'size': '10'}})
+    assert sorted(rows) == [('test.jpg', '1', '10', 'test.jpg'),
+                            ('test.txt', '1', None, 'test.txt')]
+    assert Dataset(id='2').project(['id', 'path']) == [('2', None)]
+
+
 def test_get_tags_all():
     """Concatenate all metadata tags from dataset"""
     info = {'id': '1', 'sex': 'M', 'age': 65}
@@ -615,3 +630,16 @@ def test_attributes():
     dataset = MyDataset(**info)
     # pylint: enable=W0142
     assert dataset.test == "This is a dataset"
+
+
+def test_get_tags_list_cache():
+    """Serialized metadata is cached until an attribute changes"""
+    from indexfile.utils import TagSerializer
+    dataset = Dataset(id='1', sex='M')
+    ser = TagSerializer()
+    tags, meta = dataset.get_tags_list(ser)
+    assert tags == ['id=1;', 'sex=M;']
+    assert meta == {'id': '1', 'sex': 'M'}
+    assert dataset.get_tags_list(ser)[0] is tags
+    dataset.sex = 'F'
+    assert dataset.get_tags_list(ser)[0] == ['id=1;', 'sex=F;']
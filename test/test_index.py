@@ -1,7 +1,9 @@
 """Unit test for the Index class"""
+import os
 import pytest
 import indexfile
 from indexfile.index import Index
+from indexfile.utils import StoreException, file_version
 
 
 def test_create_empty():
@@ -541,3 +543,533 @@ def test_replicates_w_metadata():
              view='json')
     i.lookup(id='aWL3.1,aWL3.2')
     i.remove(path='test/data/format.json', clear=True)
+
+
+def test_export_sort_buffer():
+    """Test export sorting rows with temporary files"""
+    i = Index('test/data/index.txt')
+    i.set_format('test/data/format.json')
+    i.open()
+    assert i.export(sort_buffer=10) == i.export()
+    assert i.export(map=None, export_type='tab', tags=['id', 'path'],
+                    sort_buffer=10) == i.export(map=None, export_type='tab',
+                                                tags=['id', 'path'])
+
+
+def test_export_tab_duplicates():
+    """Test tabular export of duplicated lines"""
+    i = Index()
+    i.insert(id='1', path='a.txt', type='txt')
+    i.insert(id='2', path='b.txt', type='txt')
+    i.insert(id='2', path='c.bam', type='bam')
+    i.insert(id='3', path='a.txt', type='bam')
+    exp = i.export(map=None, export_type='tab', tags=['type'], sort_buffer=1)
+    assert exp == ['bam', 'txt']
+    exp = i.export(map=None, export_type='tab', tags=['id', 'type'])
+    assert exp == ['1\ttxt', '2\tbam', '2\ttxt', '3\tbam']
+    exp = i.export(map=None, export_type='tab')
+    assert len(exp) == 4
+
+
+def test_export_addons():
+    """Test export of format addons"""
+    i = Index(format={'addons': {'data_type': {'mapping': 'view',
+                                               'FqRd1': 'fastq-read'}}})
+    i.insert(id='1', path='test_1.fastq', type='fastq', view='FqRd1')
+    exp = i.export(map=None, export_type='tab', tags=['path', 'data_type'])
+    assert exp == ['test_1.fastq\tfastq-read']
+    i.insert(id='1', path='test_2.fastq', type='fastq', view='FqRd1')
+    i.insert(id='1', path='test_1.fastq', type='fastq', view='Other',
+             update=True)
+    exp = i.export(map=None, export_type='tab', tags=['path', 'data_type'])
+    assert exp == ['test_1.fastq\tNA', 'test_2.fastq\tfastq-read']
+    assert 'data_type' not in i.export(map=None)[0]
+    assert 'data_type' not in i.datasets['1']['test_2.fastq']
+    i.set_format('{"addons": {"data_type": {"mapping": "view"}}}')
+    exp = i.export(map=None, export_type='tab', tags=['path', 'data_type'])
+    assert exp == ['test_1.fastq\tNA', 'test_2.fastq\tNA']
+    # the format is changed in place
+    i.format['addons']['data_type']['Other'] = 'other'
+    exp = i.export(map=None, export_type='tab', tags=['path', 'data_type'])
+    assert exp == ['test_1.fastq\tother', 'test_2.fastq\tNA']
+    del i.format['addons']
+    exp = i.export(map=None, export_type='tab', tags=['path', 'data_type'])
+    assert exp == ['test_1.fastq\tNA', 'test_2.fastq\tNA']
+
+
+def test_export_json():
+    """Test export to JSON lines"""
+    import simplejson as json
+    i = Index('test/data/index_oneline.txt')
+    i.set_format('test/data/format.json')
+    i.open()
+    exp = i.export(map=None, export_type='json')
+    assert len(exp) == 1
+    line = json.loads(exp[0])
+    assert line['labExpId'] == 'aWL3.2'
+    assert line['path'] == 'aWL3.2/aWL3.2_4204_ACTGAT_transcript.gtf'
+
+
+def test_lock_shared(tmpdir):
+    """Test shared and exclusive locks"""
+    import fcntl
+    path = str(tmpdir.join('index.txt'))
+    reader1 = Index(path)
+    reader2 = Index(path)
+    assert reader1.lock(shared=True)
+    assert reader2.lock(shared=True)
+    assert not reader1.lock()
+    with open('%s.lock' % path) as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        with pytest.raises(IOError):
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        reader1.release()
+        reader2.release()
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        writer = Index(path)
+        assert writer.lock()
+        with pytest.raises(IOError):
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        assert writer.release()
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def test_lock_timeout(tmpdir):
+    """Test lock timeout and statistics"""
+    from indexfile.utils import LockTimeout
+    path = str(tmpdir.join('index.txt'))
+    writer = Index(path)
+    assert writer.lock()
+    reader = Index(path)
+    reader.lock_timeout = 0.05
+    with pytest.raises(LockTimeout):
+        reader.lock(shared=True)
+    assert reader.lock_stats()['wait'] >= 0.05
+    writer.release()
+    stats = writer.lock_stats()
+    assert stats['count'] == 1
+    assert stats['hold'] > 0
+
+
+def test_save_concurrent(tmpdir):
+    """Test saving an index modified by someone else"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+        idx.write('b.txt\tid=2; type=txt;\n')
+    first = Index(path)
+    first.open()
+    second = Index(path)
+    second.open()
+    first.insert(id='3', path='c.txt', type='txt')
+    first.save()
+    second.remove(id='2')
+    second.insert(id='1', path='d.txt', type='txt')
+    second.save()
+    i = Index(path)
+    i.open()
+    assert sorted(i.datasets.keys()) == ['1', '3']
+    assert sorted(p for p, dummy in i.datasets['1']) == ['a.txt', 'd.txt']
+    assert not [f for f in os.listdir(str(tmpdir)) if f.startswith('.')]
+
+
+def test_save_touched(tmpdir):
+    """Test saving an index whose file was touched but not modified"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    i = Index(path)
+    i.open()
+    i.datasets['1'].sex = 'M'
+    os.utime(path, (0, 0))
+    i.save()
+    assert open(path).read() == 'a.txt\tid=1; sex=M; type=txt;\n'
+
+
+def test_save_untracked(tmpdir):
+    """Test saving changes made to the datasets directly when the index
+    file was modified by another process"""
+    from indexfile.dataset import Dataset
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    i = Index(path)
+    i.open()
+    dataset = Dataset(id='2', sex='M')
+    i.insert(dataset=dataset, path='b.txt', type='txt')
+    # the journal keeps the values at the time of the insertion
+    assert i._journal[0][1]['dataset'] is not dataset
+    i.datasets['1'].sex = 'F'
+    other = Index(path)
+    other.open()
+    other.insert(id='3', path='c.txt', type='txt')
+    other.save()
+    with pytest.raises(StoreException):
+        i.save()
+    assert 'sex' not in open(path).read()
+
+    # changes made through the index are merged
+    i = Index(path)
+    i.open()
+    i.insert(id='1', sex='F', update=True, addkeys=True)
+    i.remove(path='c.txt', clear=True)
+    other.insert(id='4', path='d.txt', type='txt')
+    other.save()
+    i.save()
+    assert open(path).read() == ('a.txt\tid=1; sex=F; type=txt;\n'
+                                 'd.txt\tid=4; type=txt;\n')
+
+
+def test_save_replaced(tmpdir):
+    """Test saving an index whose file was replaced keeping its size and
+    modification time"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    os.utime(path, (0, 0))
+    i = Index(path)
+    i.open()
+    assert i._version[1][-1] == file_version(path)[-1]
+    other = str(tmpdir.join('other.txt'))
+    with open(other, 'w') as idx:
+        idx.write('b.txt\tid=2; type=txt;\n')
+    os.utime(other, (0, 0))
+    os.rename(other, path)
+    i.insert(id='3', path='c.txt', type='txt')
+    i.save()
+    assert open(path).read() == ('b.txt\tid=2; type=txt;\n'
+                                 'c.txt\tid=3; type=txt;\n')
+    assert i._version[1] == file_version(path)
+
+
+def test_save_shared(tmpdir):
+    """Test saving an index locked shared"""
+    path = str(tmpdir.join('index.txt'))
+    i = Index(path)
+    i.insert(id='1', path='a.txt', type='txt')
+    i.lock(shared=True)
+    with pytest.raises(StoreException):
+        i.save()
+    i.release()
+    i.save()
+    assert os.path.exists(path)
+
+
+def test_threadsafe(tmpdir):
+    """Test concurrent readers and writers on a thread-safe index"""
+    import threading
+    path = str(tmpdir.join('index.txt'))
+    i = Index(path, threadsafe=True)
+    errors = []
+
+    def writer(n):
+        try:
+            for j in range(50):
+                i.insert(id=str(j % 10), path='%d_%d.txt' % (n, j), type='txt')
+                if j % 7 == 0:
+                    i.remove(id=str((j + n) % 10))
+        except Exception, exc:
+            errors.append(exc)
+
+    def reader():
+        try:
+            for dummy in range(50):
+                i.lookup(type='txt')
+                for line in i.iter_export():
+                    assert '\t' in line
+                i.export(export_type='tab', tags=['id', 'path'])
+        except Exception, exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    threads += [threading.Thread(target=reader) for dummy in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    i.save()
+    saved = Index(path)
+    saved.open()
+    assert saved.export() == i.export()
+
+
+def test_save_generations(tmpdir):
+    """Test saving the index as generation files"""
+    import fcntl
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    i = Index(path)
+    i.open()
+    i.generations = True
+    i.insert(id='2', path='b.txt', type='txt')
+    i.save()
+    assert os.readlink(path) == 'index.txt.gen1'
+    # a reader holding the current generation
+    reader = open(str(tmpdir.join('index.txt.gen1')))
+    fcntl.flock(reader, fcntl.LOCK_SH)
+    # the layout is kept by other instances
+    j = Index(path)
+    j.open()
+    j.insert(id='3', path='c.txt', type='txt')
+    j.save()
+    assert os.readlink(path) == 'index.txt.gen2'
+    assert os.path.exists(str(tmpdir.join('index.txt.gen1')))
+    reader.close()
+    j.remove(id='1')
+    j.save()
+    assert sorted(os.listdir(str(tmpdir))) == ['index.txt', 'index.txt.gen3',
+                                                'index.txt.lock']
+    k = Index(path)
+    k.open()
+    assert sorted(k.datasets.keys()) == ['2', '3']
+    # generations newer than one in use are kept until it is released
+    reader = open(str(tmpdir.join('index.txt.gen3')))
+    fcntl.flock(reader, fcntl.LOCK_SH)
+    k.insert(id='4', path='d.txt', type='txt')
+    k.save()
+    k.insert(id='5', path='e.txt', type='txt')
+    k.save()
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'index.txt', 'index.txt.gen3', 'index.txt.gen4', 'index.txt.gen5',
+        'index.txt.lock']
+    reader.close()
+    k.remove(id='5')
+    k.save()
+    assert sorted(os.listdir(str(tmpdir))) == ['index.txt', 'index.txt.gen6',
+                                                'index.txt.lock']
+
+
+def test_remove_many():
+    """Test removing files and datasets with many queries"""
+    i = Index()
+    i.insert(id='1', age=65, path='test.txt', type='txt')
+    i.insert(id='1', path='test1.txt', type='txt')
+    i.insert(id='1', path='test1.jpg', type='jpeg')
+    i.insert(id='2', path='test2.txt', type='txt')
+    i.insert(id='3', path='test3.txt', type='txt')
+    i.remove({'path': 'test.txt'}, {'id': '2'}, {'path': 'test3.txt'},
+             clear=True)
+    assert sorted(i.datasets.keys()) == ['1']
+    assert sorted(p for p, dummy in i.datasets['1']) == ['test1.jpg',
+                                                          'test1.txt']
+    # dataset and file information in the same query
+    i.remove(id='1', type='txt', path='test1.txt')
+    assert [p for p, dummy in i.datasets['1']] == ['test1.jpg']
+
+
+def test_remove_many_sequential():
+    """Test removing with many queries as with one query at a time"""
+    queries = [{'type': 'big.*'}, {'view': 'Fastq.*', 'type': 'fastq'},
+               {'id': 'aWL3.*'}, {'labExpId': 'AL3.1'},
+               {'path': '/users/rg/epalumbo/projects/ERC/fly/bp.pipeline/'
+                        'vWL3.2/vWL3.2_4197_ATCACG_m4_n10.ssj'}]
+    for exact in [False, True]:
+        many = Index('test/data/index.txt')
+        many.set_format('test/data/format.json')
+        many.open()
+        one = Index('test/data/index.txt')
+        one.set_format('test/data/format.json')
+        one.open()
+        # removed files are the ones looked up
+        found = one.lookup(exact=exact, **queries[0])
+        assert found.export(map=None) or exact
+        one.remove(exact=exact, **queries[0])
+        assert not set(found.export(map=None)) & set(one.export(map=None))
+        for query in queries[1:]:
+            one.remove(exact=exact, **query)
+        many.remove(*queries, exact=exact)
+        assert many.export() == one.export()
+
+
+def test_insert_many(tmpdir):
+    """Test bulk insertion"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    i = Index(path)
+    i.open()
+    # changes made by others before the lock are merged
+    other = Index(path)
+    other.open()
+    other.insert(id='2', path='b.txt', type='txt')
+    other.save()
+    i.lock()
+    rows = (dict(id=str(n), path='%d.txt' % n, type='txt')
+            for n in range(3, 10))
+    assert i.insert_many(rows, log_every=2) == 7
+    assert i._journal is None
+    i.save()
+    i.release()
+    saved = Index(path)
+    saved.open()
+    assert sorted(saved.datasets.keys()) == [str(n) for n in range(1, 10)]
+
+
+def test_stats(tmpdir):
+    """Test index statistics"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+        idx.write('b.txt\tid=2; type=txt;\n')
+    i = Index(path)
+    i.open()
+    assert i.stats().keys() == ['lock']
+    Index.collect_stats = True
+    try:
+        i = Index(path)
+        i.open()
+        i.insert(id='1', path='c.txt', type='txt')
+        i.lookup(id='2')
+        i.save()
+        stats = i.stats()
+    finally:
+        Index.collect_stats = False
+    assert stats['lines_parsed'] == 2
+    assert stats['datasets_inserted'] == 2
+    assert stats['files_inserted'] == 3
+    assert stats['lookups'] == 1
+    assert stats['datasets_scanned'] == 2
+    assert stats['datasets_matched'] == 1
+    assert stats['saves'] == 1
+    assert stats['bytes_written'] == os.path.getsize(path)
+    assert sorted(stats['time']) == ['export', 'insert', 'lookup', 'open',
+                                     'save']
+    assert stats['lock']['count'] == 1
+
+
+def test_lazy(tmpdir):
+    """Test lazy parsing of index lines"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tdesc="x id=3"; id=1; type=txt;\n')
+        idx.write('b.txt\tdesc="x id=3"; id=1; type=txt;\n')
+        idx.write('c.txt\tdesc=y; id=2; type=txt;\n')
+    Index.lazy = True
+    try:
+        i = Index(path)
+        i.open()
+    finally:
+        Index.lazy = False
+    assert sorted(i.datasets.keys()) == ['1', '2']
+    result = i.lookup(id='2', exact=True)
+    assert result.datasets.keys() == ['2']
+    assert '_raw' in i.datasets['2'].__dict__
+    assert sorted(p for p, dummy in i.datasets['1']) == ['a.txt', 'b.txt']
+    assert i.datasets['1'].desc == 'x id=3'
+    assert i.datasets['2']['c.txt'] == {'type': 'txt'}
+    assert '_raw' not in i.datasets['2'].__dict__
+
+    # replicates decode their datasets
+    with open(path, 'a') as idx:
+        idx.write('d.txt\tdesc=z; id=1,2; type=txt;\n')
+    Index.lazy = True
+    try:
+        i = Index(path)
+        i.open()
+    finally:
+        Index.lazy = False
+    assert sorted(i.datasets.keys()) == ['1', '1,2', '2']
+    assert '_raw' not in i.datasets['1'].__dict__
+
+
+def test_batch(tmpdir):
+    """Test deferring saves in a batch"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    i = Index(path)
+    i.open()
+    with i.batch():
+        assert i._lock is not None
+        i.insert(id='2', path='b.txt', type='txt')
+        i.save()
+        with i.batch():
+            i.remove(id='1')
+            i.save()
+        assert open(path).read() == 'a.txt\tid=1; type=txt;\n'
+    assert i._lock is None
+    assert open(path).read() == 'b.txt\tid=2; type=txt;\n'
+    with pytest.raises(ValueError):
+        with i.batch():
+            i.insert(id='3', path='c.txt', type='txt')
+            i.save()
+            raise ValueError()
+    assert open(path).read() == 'b.txt\tid=2; type=txt;\n'
+    # the changes made in a failed batch are discarded
+    assert i.datasets.keys() == ['2']
+    i.insert(id='4', path='d.txt', type='txt')
+    with pytest.raises(ValueError):
+        with i.batch():
+            i.remove(id='2')
+            raise ValueError()
+    assert sorted(i.datasets.keys()) == ['2', '4']
+    memory = Index(datasets=i.datasets, format=i.format)
+    with pytest.raises(ValueError):
+        with memory.batch():
+            memory.remove(id='4')
+            raise ValueError()
+    assert sorted(memory.datasets.keys()) == ['2', '4']
+
+
+def test_poll(tmpdir):
+    """Test loading the changes made to the index file"""
+    import subprocess
+    import sys
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    i = Index(path)
+    i.open()
+    assert i.poll() is None
+    with open(path, 'a') as idx:
+        idx.write('b.txt\tid=1; type=txt;\nc.txt\tid=2; type=txt;\n')
+    added = i.poll()
+    assert sorted(added.datasets.keys()) == ['1', '2']
+    assert [p for p, dummy in added.datasets['1']] == ['b.txt']
+    assert sorted(p for p, dummy in i.datasets['1']) == ['a.txt', 'b.txt']
+    assert i.poll() is None
+    assert i._journal == []
+    # a line being written is loaded when complete
+    with open(path, 'a') as idx:
+        idx.write('d.txt\tid=3; ty')
+    assert i.poll() is None
+    with open(path, 'a') as idx:
+        idx.write('pe=txt;\n')
+    added = i.poll()
+    assert added.datasets.keys() == ['3']
+    assert [p for p, dummy in i.datasets['3']] == ['d.txt']
+    assert i._journal == []
+
+    # the file is saved by another process
+    script = ('from indexfile.index import Index\n'
+              'i = Index(%r)\n'
+              'i.open()\n'
+              'i.remove(id="2")\n'
+              'i.insert(id="4", path="e.txt", type="txt")\n'
+              'i.save()\n' % path)
+    assert subprocess.call([sys.executable, '-c', script]) == 0
+    i.insert(id='5', path='f.txt', type='txt')
+    added = i.poll()
+    assert added.datasets.keys() == ['4']
+    assert sorted(i.datasets.keys()) == ['1', '3', '4', '5']
+    assert i.poll() is None
+
+    # datasets with changed metadata are returned with all their files
+    script = ('from indexfile.index import Index\n'
+              'i = Index(%r)\n'
+              'i.open()\n'
+              'i.insert(id="1", sex="F", update=True, addkeys=True)\n'
+              'i.save()\n' % path)
+    assert subprocess.call([sys.executable, '-c', script]) == 0
+    added = i.poll()
+    assert added.datasets.keys() == ['1']
+    assert sorted(p for p, dummy in added.datasets['1']) == ['a.txt', 'b.txt']
+    assert i.datasets['1'].sex == 'F'
+    # changes saved by this instance are not loaded again
+    i.save()
+    assert i.poll() is None
+
+    changes = list(i.watch(interval=0.01, timeout=0.05))
+    assert changes == []
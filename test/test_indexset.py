@@ -0,0 +1,56 @@
+"""Unit test for the IndexSet class"""
+import pytest
+from indexfile.indexset import IndexSet, expand_paths, is_index_set
+
+
+@pytest.fixture
+def paths(tmpdir):
+    """Create three index files"""
+    files = []
+    for name in ['a', 'b', 'c']:
+        path = tmpdir.mkdir(name).join('index.txt')
+        path.write('%s.txt\tid=%s1; sex=M; type=txt;\n'
+                   'z%s.txt\tid=%s2; sex=F; type=txt;\n' % ((name,) * 4))
+        files.append(str(path))
+    return files
+
+
+def test_expand_paths(paths, tmpdir):
+    """Expand glob patterns and lists"""
+    assert expand_paths('%s/*/index.txt' % tmpdir) == paths
+    assert expand_paths(','.join(paths[:2])) == paths[:2]
+    assert is_index_set('%s/*/index.txt' % tmpdir)
+    assert is_index_set(','.join(paths))
+    assert not is_index_set(paths[0])
+
+
+def test_export(paths):
+    """Query many indexes in parallel"""
+    iset = IndexSet(paths, processes=2)
+    lines = iset.export(query={'sex': 'F'}, export_type='tab',
+                        tags=['id', 'path'], header=True)
+    assert lines == ['source\tid\tpath'] + [
+        '%s\t%s2\tz%s.txt' % (path, name, name)
+        for path, name in zip(paths, 'abc')]
+    lines = iset.export()
+    assert len(lines) == 6
+    assert lines[0] == 'a.txt\tid=a1; sex=M; source=%s; type=txt;' % paths[0]
+    assert [l.split('\t')[0] for l in lines] == sorted(
+        l.split('\t')[0] for l in lines)
+    pytest.raises(ValueError, iset.export, export_type='tab')
+
+
+def test_count(paths):
+    """Count the datasets of many indexes"""
+    from indexfile.index import Index
+    iset = IndexSet(paths, processes=2)
+    assert iset.count() == 6
+    assert iset.count({'sex': 'F'}) == 3
+    assert iset.count({'id': 'a.*'}) == 2
+    # files of the same dataset are not counted
+    index = Index(paths[0])
+    index.open()
+    index.insert(id='a1', path='b.txt', type='txt')
+    index.save()
+    assert iset.count({'sex': 'M'}) == 3
+    assert IndexSet([]).count() == 0
@@ -0,0 +1,103 @@
+"""Unit test for the index server"""
+import os
+import shutil
+import threading
+from StringIO import StringIO
+from indexfile import server
+from indexfile.server import IndexServer
+
+
+def start_server(tmpdir):
+    """Start a server in a background thread"""
+    srv = IndexServer(str(tmpdir.join('idx.sock')))
+    thread = threading.Thread(target=srv.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return srv
+
+
+def test_request(tmpdir):
+    """Run a command on the server"""
+    path = str(tmpdir.join('index.txt'))
+    shutil.copy('test/data/index.txt', path)
+    fmt = os.path.abspath('test/data/format.json')
+    srv = start_server(tmpdir)
+    try:
+        assert server.ping(srv.socket_path)
+        out, err = StringIO(), StringIO()
+        config = {'index': path, 'format': fmt}
+        status = server.request('show', ['-c'], config, srv.socket_path,
+                                out, err)
+        assert status == 0
+        assert out.getvalue().strip() == '36'
+        # the index is reloaded when the file changes
+        with open(path, 'a') as index_file:
+            index_file.write('/data/new.bam\tlabExpId=new; type=bam;\n')
+        out = StringIO()
+        status = server.request('show', ['-c'], config, srv.socket_path,
+                                out, err)
+        assert out.getvalue().strip() == '37'
+        # errors return a non zero status
+        status = server.request('show', ['--bad'], config, srv.socket_path,
+                                StringIO(), err)
+        assert status != 0
+    finally:
+        srv.shutdown()
+        srv.server_close()
+    assert not os.path.exists(srv.socket_path)
+    assert server.request('show', [], config, srv.socket_path) is None
+
+
+def test_request_failure(tmpdir):
+    """Reload the index after a failed command"""
+    path = str(tmpdir.join('index.txt'))
+    shutil.copy('test/data/index.txt', path)
+    fmt = os.path.abspath('test/data/format.json')
+    srv = start_server(tmpdir)
+    try:
+        config = {'index': path, 'format': fmt}
+        assert server.request('show', ['-c'], config, srv.socket_path,
+                              StringIO(), StringIO()) == 0
+        key = (path, fmt)
+        index = srv._indexes[key][0]
+        # change the cached index in memory without saving it
+        index.remove(labExpId='AL3.1')
+        assert len(index.datasets) == 35
+        status = server.request('show', ['--bad'], config, srv.socket_path,
+                                StringIO(), StringIO())
+        assert status != 0
+        assert key not in srv._indexes
+        out = StringIO()
+        server.request('show', ['-c'], config, srv.socket_path, out,
+                       StringIO())
+        assert out.getvalue().strip() == '36'
+    finally:
+        srv.shutdown()
+        srv.server_close()
+
+
+def test_private_dir(tmpdir):
+    """Create the socket folder only accessible by the current user"""
+    import stat
+    import pytest
+    path = str(tmpdir.join('private'))
+    assert server.private_dir(path) == path
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0700
+    assert server.private_dir(path) == path
+    os.chmod(path, 0777)
+    with pytest.raises(ValueError):
+        server.private_dir(path)
+
+
+def test_socket_owner(tmpdir):
+    """Do not use sockets owned by other users"""
+    import pytest
+    if os.getuid() != 0:
+        pytest.skip('changing the file owner requires root')
+    path = str(tmpdir.join('idx.sock'))
+    open(path, 'w').close()
+    os.chown(path, 65534, 65534)
+    assert not server.is_owned(path)
+    assert server.request('show', [], {}, path) is None
+    with pytest.raises(ValueError):
+        IndexServer(path)
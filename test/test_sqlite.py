@@ -0,0 +1,70 @@
+"""Unit test for the SQLiteIndex class"""
+import pytest
+from indexfile.index import Index
+from indexfile.sqlite import SQLiteIndex, is_sqlite
+
+
+@pytest.fixture
+def dbpath(tmpdir):
+    """Create a database from the test index"""
+    i = Index()
+    i.set_format('test/data/format.json')
+    i.open('test/data/index.txt')
+    path = str(tmpdir.join('index.db'))
+    SQLiteIndex.create(path, i, indexed=['view'])
+    return path
+
+
+def test_create(dbpath):
+    """Create database from index"""
+    assert is_sqlite(dbpath)
+    assert not is_sqlite('test/data/index.txt')
+    i = SQLiteIndex()
+    i.open(dbpath)
+    assert i.format.get('id') == 'labExpId'
+    assert i.indexed == ['view']
+    assert len(i) == 36
+    assert i.datasets == {}
+
+
+def test_lookup(dbpath):
+    """Query the database"""
+    i = Index()
+    i.set_format('test/data/format.json')
+    i.open('test/data/index.txt')
+    sqli = SQLiteIndex(dbpath)
+    sqli.open()
+    for query in [{'id': 'WLP.2'}, {'type': 'gtf'}, {'view': 'Fastq.*'},
+                  {'type': 'bam', 'tissue': 'wing'}, {'path': '.*bigwig'},
+                  {'path': '/users/rg/epalumbo/projects/ERC/fly/bp.pipeline/'
+                           'EL3.1/EL3.1_5355_ATCACG.minusRaw.bigwig'},
+                  {'age': ['L3', 'pupa']}, {'unknown': 'x'}]:
+        exp = i.lookup(**dict(query)).export()
+        assert sqli.lookup(**dict(query)).export() == exp
+    exp = i.lookup(exact=True, view='FastqRd1').export()
+    assert sqli.lookup(exact=True, view='FastqRd1').export() == exp
+    assert sqli.datasets == {}
+
+
+def test_export(dbpath):
+    """Export the database to the index file format"""
+    i = Index()
+    i.set_format('test/data/format.json')
+    i.open('test/data/index.txt')
+    sqli = SQLiteIndex(dbpath)
+    sqli.open()
+    # datasets without files are not sorted
+    assert sorted(sqli.to_index().export()) == sorted(i.export())
+    assert sorted(sqli.export(map=None)) == sorted(i.export(map=None))
+
+
+def test_insert_save(dbpath):
+    """Insert a dataset and save the database"""
+    i = SQLiteIndex(dbpath)
+    i.open()
+    i.insert(labExpId='new', path='new.txt', type='txt', view='Text')
+    i.save()
+    i = SQLiteIndex(dbpath)
+    i.open()
+    assert len(i) == 37
+    assert len(i.lookup(view='Text')) == 1
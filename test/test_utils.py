@@ -1,5 +1,7 @@
 """Test utility methods"""
 
+import os
+import pytest
 from indexfile import utils as u
 from copy import deepcopy
 
@@ -208,3 +210,141 @@ def test_deepcopy():
     assert getattr(cp.info, 'path')
     assert getattr(cp.info, 'type')
     assert getattr(cp.info, 'view')
+
+
+def test_sort_rows():
+    """Sort rows in memory"""
+    rows = [{'a': 3}, {'a': 1}, {'a': 2}]
+    out = list(u.sort_rows(rows, lambda x: x['a']))
+    assert out == [{'a': 1}, {'a': 2}, {'a': 3}]
+
+
+def test_sort_rows_buffer():
+    """Sort rows spilling sorted runs to temporary files"""
+    rows = [{'a': i % 7, 'b': i} for i in range(50)]
+    out = list(u.sort_rows(rows, lambda x: x['a'], buffer_size=8))
+    assert out == sorted(rows, key=lambda x: x['a'])
+
+
+def test_tag_serializer():
+    """Join pre-serialized tags"""
+    ser = u.TagSerializer()
+    meta = ser.tag_list([('id', '1'), ('desc', 'A test')])
+    line = ser.join(meta, ser.tag_list([('type', 'txt')]))
+    assert line == u.to_tags(id='1', desc='A test', type='txt')
+    assert line == 'desc="A test"; id=1; type=txt;'
+
+
+def test_json_backend():
+    """Encode rows with the selected JSON backend"""
+    import simplejson as json
+    dumps = u.json_backend('simplejson')
+    rows = [{'id': '1', 'path': 'a/b.txt'}, {'path': 'c "d"', 'id': 2}, {}]
+    for row in rows:
+        assert json.loads(dumps(row, sort_keys=True)) == row
+    assert dumps(rows[0], sort_keys=True) == '{"id":"1","path":"a/b.txt"}'
+    with pytest.raises(ValueError):
+        u.json_backend('unknown')
+
+
+def test_json_backends():
+    """All the JSON backends produce the same output"""
+    pytest.importorskip('ujson')
+    rows = [{'id': '1', 'path': 'a/b.txt', 'size': 10, 'md5': None},
+            {'path': 'c "d"\te\\', 'id': 'x/y'}, {}]
+    for row in rows:
+        assert u.json_backend('ujson')(row, sort_keys=True) == \
+            u.json_backend('simplejson')(row, sort_keys=True)
+
+
+def test_file_lock_timeout(tmpdir):
+    """Give up acquiring a lock after a timeout"""
+    import pytest
+    path = str(tmpdir.join('index.txt.lock'))
+    holder = u.FileLock(path)
+    holder.acquire()
+    assert holder.holder()[0] == os.getpid()
+    lock = u.FileLock(path, shared=True)
+    with pytest.raises(u.LockTimeout):
+        lock.acquire(timeout=0.1)
+    assert lock.wait_time >= 0.1
+    holder.release()
+    assert holder.hold_time is not None
+    lock.acquire(timeout=0.1)
+    assert lock.is_locked()
+    lock.release()
+
+
+def test_file_lock_dead_holder(tmpdir):
+    """Never break a lock held on behalf of a dead process"""
+    import fcntl
+    import socket
+    import pytest
+    path = str(tmpdir.join('index.txt.lock'))
+    with open(path, 'w') as stale:
+        stale.write('999999999@%s\n' % socket.gethostname())
+        stale.flush()
+        fcntl.flock(stale, fcntl.LOCK_EX)
+        lock = u.FileLock(path)
+        with pytest.raises(u.LockTimeout):
+            lock.acquire(timeout=0.1)
+        assert os.path.exists(path)
+        assert not lock.is_locked()
+    # the kernel releases the lock when the holder closes the file
+    lock.acquire(timeout=1)
+    assert lock.holder()[0] == os.getpid()
+    lock.release()
+
+
+def test_file_lock_shared(tmpdir):
+    """Readers and writers exclude each other"""
+    import pytest
+    path = str(tmpdir.join('index.txt.lock'))
+    reader = u.FileLock(path, shared=True)
+    reader.acquire()
+    writer = u.FileLock(path)
+    with pytest.raises(u.LockTimeout):
+        writer.acquire(timeout=0.1)
+    reader.release()
+    writer.acquire(timeout=1)
+    writer.release()
+
+
+def test_rw_lock():
+    """Test readers-writer lock"""
+    import threading
+    lock = u.RWLock()
+    token = lock.acquire_read()
+    # reentrant reads while holding the lock
+    with lock.reading():
+        pass
+    state = []
+    writer = threading.Thread(target=lambda: lock.acquire_write() or
+                              state.append('write'))
+    writer.start()
+    writer.join(0.1)
+    assert state == []
+    lock.release_read(token)
+    writer.join(1)
+    assert state == ['write']
+    # only the writer thread can release the write lock
+    with pytest.raises(RuntimeError):
+        lock.release_write()
+    with pytest.raises(RuntimeError):
+        lock.release_read()
+
+
+def test_checksum_file(tmpdir):
+    """Compute the version of a file while reading it"""
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as out:
+        out.write('a.txt\tid=1;\nb.txt\tid=2;\n')
+    with open(path) as in_file:
+        wrapped = u.ChecksumFile(in_file)
+        assert wrapped.readline() == 'a.txt\tid=1;\n'
+        wrapped.seek(0)
+        assert list(wrapped) == ['a.txt\tid=1;\n', 'b.txt\tid=2;\n']
+        assert wrapped.version() == u.file_version(path)
+        wrapped.seek(12)
+        assert wrapped.version() == u.file_version(path)
+        assert wrapped.tell() == 12
@@ -0,0 +1,94 @@
+"""Unit test for the IndexWriter class"""
+import time
+import threading
+from indexfile.index import Index
+from indexfile.writer import IndexWriter
+
+
+def test_writer_threads(tmpdir):
+    """Queue insertions from many threads"""
+    path = str(tmpdir.join('index.txt'))
+    index = Index(path)
+    saves = []
+    save = index.save
+    index.save = lambda *args, **kwargs: saves.append(1) or save(*args,
+                                                                 **kwargs)
+
+    def worker(n):
+        for j in range(10):
+            writer.insert(id=str(n), path='%d_%d.txt' % (n, j), type='txt')
+
+    with IndexWriter(index, batch_size=25, interval=60) as writer:
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    assert len(writer) == 0
+    assert 1 <= len(saves) <= 3
+    i = Index(path)
+    i.open()
+    assert len(i) == 5
+    assert sum(len(d) for d in i.datasets.values()) == 50
+
+
+def test_writer_interval(tmpdir):
+    """Write queued changes after the time interval"""
+    path = str(tmpdir.join('index.txt'))
+    writer = IndexWriter(Index(path), interval=0.05)
+    writer.start()
+    writer.insert(id='1', path='a.txt', type='txt')
+    writer.insert(id='1', path='a.txt', type='txt')
+    assert len(writer) == 1
+    for dummy in range(100):
+        if not len(writer):
+            break
+        time.sleep(0.01)
+    writer.close()
+    i = Index(path)
+    i.open()
+    assert len(i) == 1
+    writer = IndexWriter(i)
+    writer.remove(id='1')
+    assert writer.flush() == 1
+    assert open(path).read() == ''
+
+
+def test_writer_coalesce(tmpdir):
+    """Coalesce changes queued again for the same dataset and file"""
+    writer = IndexWriter(Index(str(tmpdir.join('index.txt'))))
+    writer.insert(id='1', path='a.txt', type='txt')
+    writer.insert(id='1', path='b.txt', type='txt')
+    writer.insert(id='1', path='a.txt', type='txt')
+    assert len(writer) == 2
+    # the file is inserted again after removing the dataset
+    writer.remove(id='1')
+    writer.insert(id='1', path='a.txt', type='txt')
+    writer.remove(id='1')
+    assert len(writer) == 5
+    writer.flush()
+    assert open(writer.index.path).read() == ''
+
+
+def test_writer_failure(tmpdir):
+    """Keep the changes of a failed batch and do not overwrite the index
+    file"""
+    import pytest
+    from indexfile.utils import LockTimeout
+    path = str(tmpdir.join('index.txt'))
+    with open(path, 'w') as idx:
+        idx.write('a.txt\tid=1; type=txt;\n')
+    index = Index(path)
+    index.lock_timeout = 0.1
+    writer = IndexWriter(index)
+    writer.insert(id='2', path='b.txt', type='txt')
+    holder = Index(path)
+    holder.lock()
+    with pytest.raises(LockTimeout):
+        writer.flush()
+    assert len(writer) == 1
+    holder.release()
+    assert writer.flush() == 1
+    assert open(path).read() == ('a.txt\tid=1; type=txt;\n'
+                                 'b.txt\tid=2; type=txt;\n')